@@ -1,10 +1,56 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, g, Response, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import parse_header_links
 import base64
-from datetime import datetime, timedelta
+import binascii
+from datetime import datetime, timezone
 import sqlite3
+import queue
+import atexit
 import os
+import math
+import json
+import gzip
+import hashlib
+import io
+import csv
+import heapq
+from array import array
+import xml.etree.ElementTree as ET
+import ipaddress
+import time
+import threading
+import random
+import logging
+import asyncio
+import socket
+import sys
+import tempfile
+from collections import OrderedDict, defaultdict, Counter, deque
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from email.utils import parsedate_to_datetime
+from functools import wraps
+from contextlib import contextmanager
+from werkzeug.serving import make_server
+from werkzeug.http import parse_accept_header, parse_etags
+from werkzeug.datastructures import MultiDict, Headers
 from dotenv import load_dotenv
+import click
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Modo asíncrono (ASGI): opcional, solo necesario para `uvicorn main:asgi_app` y el benchmark
+try:
+    import aiohttp
+    import uvicorn
+except ImportError:
+    aiohttp = uvicorn = None
 
 # Cargar variables de entorno
 load_dotenv()
@@ -18,6 +64,9 @@ SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token'
 SPOTIFY_API_URL = 'https://api.spotify.com/v1'
+SPOTIFY_ARTISTA_DEADLINE = float(os.getenv('SPOTIFY_ARTISTA_DEADLINE', 8))
+SPOTIFY_TOKEN_MARGEN = float(os.getenv('SPOTIFY_TOKEN_MARGEN', 300))
+SPOTIFY_TOKEN_BACKOFF_MAX = float(os.getenv('SPOTIFY_TOKEN_BACKOFF_MAX', 300))
 
 # TMDB (Películas)
 TMDB_API_KEY = os.getenv('TMDB_API_KEY')
@@ -26,26 +75,663 @@ TMDB_IMAGE_BASE = 'https://image.tmdb.org/t/p/w500'
 
 # Clima
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
+CLIMA_GRID = float(os.getenv('CLIMA_GRID', 0.1))
+CLIMA_CONFIAR_PROXY = os.getenv('CLIMA_CONFIAR_PROXY', 'False').lower() == 'true'
 
 # Divisas
 EXCHANGE_API_KEY = os.getenv('EXCHANGE_API_KEY')
 EXCHANGE_BASE_URL = 'https://v6.exchangerate-api.com/v6'
+DIVISAS_BASE = os.getenv('DIVISAS_BASE', 'USD').upper()
+DIVISAS_REFRESCO = float(os.getenv('DIVISAS_REFRESCO', 21600))
+DIVISAS_REINTENTO = float(os.getenv('DIVISAS_REINTENTO', 300))
+DIVISAS_LOTE_MAX = int(os.getenv('DIVISAS_LOTE_MAX', 10000))
 
 # GitHub
 GITHUB_API = 'https://api.github.com'
+GITHUB_MAX_PAGINAS = int(os.getenv('GITHUB_MAX_PAGINAS', 10))
 
 # Google Books
 GOOGLE_BOOKS_API = 'https://www.googleapis.com/books/v1/volumes'
 
+# Lugares (OpenStreetMap Overpass)
+OVERPASS_URL = os.getenv('OVERPASS_URL', 'http://overpass-api.de/api/interpreter')
+LUGARES_MAX_TILES = int(os.getenv('LUGARES_MAX_TILES', 36))
+LUGARES_RADIO_MAX = int(os.getenv('LUGARES_RADIO_MAX', 10000))
+LUGARES_FUENTE = os.getenv('LUGARES_FUENTE', 'overpass').lower()
+LUGARES_INDICE = os.getenv('LUGARES_INDICE', 'lugares_osm.json')
+LUGARES_INDICE_CELDA = float(os.getenv('LUGARES_INDICE_CELDA', 0.01))
+
 # Base de datos
 DATABASE = os.getenv('DATABASE_NAME', 'productos.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 5))
+DB_CACHE_KB = int(os.getenv('DB_CACHE_KB', 20000))
+DB_MMAP_BYTES = int(os.getenv('DB_MMAP_BYTES', 268435456))
+PRODUCTOS_LIMITE_DEFECTO = int(os.getenv('PRODUCTOS_LIMITE_DEFECTO', 100))
+PRODUCTOS_LIMITE_MAX = int(os.getenv('PRODUCTOS_LIMITE_MAX', 500))
+COLUMNAS_ORDEN_PRODUCTOS = ('id', 'nombre', 'precio', 'stock', 'fecha_creacion')
+STOCK_BAJO_UMBRAL = int(os.getenv('STOCK_BAJO_UMBRAL', 5))
+IMPORTACION_LOTE = int(os.getenv('IMPORTACION_LOTE', 1000))
+IMPORTACION_MAX_ERRORES = int(os.getenv('IMPORTACION_MAX_ERRORES', 1000))
+EXPORTACION_LOTE = int(os.getenv('EXPORTACION_LOTE', 500))
 
-# Cache para tokens
+# Cache para tokens (tiempos en time.monotonic)
 _token_cache = {
     'access_token': None,
-    'expiry': None
+    'expiry': 0,
+    'refrescar_en': 0,
+    'fallos': 0,
+    'reintentar_en': 0,
+    'timer': None
+}
+_token_refresco_lock = threading.Lock()
+
+# ==================== CLIENTE HTTP COMPARTIDO ====================
+# Pools de conexiones keep-alive por host (configurables desde .env)
+UPSTREAM_POOL_CONNECTIONS = int(os.getenv('UPSTREAM_POOL_CONNECTIONS', 16))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', 32))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+UPSTREAM_TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', 10))
+
+def crear_sesion_http():
+    """Crear sesión con pools de conexiones reutilizables por host"""
+    sesion = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+        pool_block=False
+    )
+    sesion.mount('https://', adapter)
+    sesion.mount('http://', adapter)
+    return sesion
+
+http = crear_sesion_http()
+
+def upstream_request(method, url, timeout=None, proveedor=None, prioridad='interactiva', **kwargs):
+    """Petición a una API externa usando la sesión compartida, timeouts por defecto y la cuota del proveedor"""
+    read_timeout = timeout if timeout is not None else UPSTREAM_TIMEOUT
+    if proveedor is None:
+        return http.request(method, url, timeout=(UPSTREAM_CONNECT_TIMEOUT, read_timeout), **kwargs)
+    
+    # Circuit breaker, cuota y bulkhead: si alguno rechaza, se falla rápido sin llamar
+    circuito = circuito_de(proveedor)
+    circuito.permitir()
+    try:
+        cuotas_upstream.reservar(proveedor, prioridad)
+        if not circuito.bulkhead.acquire(timeout=BULKHEAD_ESPERA):
+            circuito.contar('saturadas')
+            raise ProveedorSaturado(proveedor, 1)
+    except UpstreamNoDisponible:
+        circuito.cancelar()
+        raise
+    
+    inicio = time.monotonic()
+    try:
+        response = http.request(method, url, timeout=(UPSTREAM_CONNECT_TIMEOUT, read_timeout), **kwargs)
+    except Exception:
+        circuito.registrar(False)
+        raise
+    finally:
+        circuito.bulkhead.release()
+    
+    circuito.registrar(response.status_code < 500 and time.monotonic() - inicio <= circuito.latencia_lenta)
+    cuotas_upstream.actualizar(proveedor, response)
+    return response
+
+def upstream_get(url, **kwargs):
+    return upstream_request('GET', url, **kwargs)
+
+def upstream_post(url, **kwargs):
+    return upstream_request('POST', url, **kwargs)
+
+# Pool de hilos acotado para lanzar peticiones externas en paralelo
+UPSTREAM_WORKERS = int(os.getenv('UPSTREAM_WORKERS', 16))
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix='upstream')
+
+def esperar_respuesta(futuro, limite):
+    """Esperar un futuro hasta el instante límite (time.monotonic); None si no llegó a tiempo o falló"""
+    try:
+        return futuro.result(timeout=max(0, limite - time.monotonic()))
+    except Exception:
+        futuro.cancel()
+        return None
+
+# ==================== CUOTAS DE APIs EXTERNAS ====================
+CUOTA_RESERVA = int(os.getenv('CUOTA_RESERVA', 5))
+CUOTA_ESPERA_MAX = float(os.getenv('CUOTA_ESPERA_MAX', 2))
+CUOTA_BLOQUEO_429 = float(os.getenv('CUOTA_BLOQUEO_429', 30))
+
+class UpstreamNoDisponible(Exception):
+    """No se llamó al proveedor; se puede reintentar dentro de retry_after segundos"""
+    mensaje = '{proveedor} no disponible'
+
+    def __init__(self, proveedor, retry_after):
+        super().__init__(self.mensaje.format(proveedor=proveedor))
+        self.proveedor = proveedor
+        self.retry_after = retry_after
+
+class CuotaAgotada(UpstreamNoDisponible):
+    """El proveedor no tiene presupuesto hasta dentro de retry_after segundos"""
+    mensaje = 'Límite de peticiones de {proveedor} agotado'
+
+def segundos_retry_after(valor):
+    """Interpretar Retry-After en segundos o como fecha HTTP; None si no es válido"""
+    if not valor:
+        return None
+    try:
+        return max(float(valor), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+class CuotasUpstream:
+    """Presupuesto por proveedor aprendido de sus cabeceras de rate limit (GitHub, Reddit, Retry-After)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._estado = defaultdict(lambda: {'restantes': None, 'reinicio': 0, 'bloqueado_hasta': 0})
+
+    def intentar_reservar(self, proveedor, prioridad='interactiva'):
+        """Consumir una unidad si hay presupuesto; devuelve 0 o los segundos que habría que esperar"""
+        # Las peticiones de fondo (refrescos) dejan CUOTA_RESERVA unidades para los usuarios
+        minimo = CUOTA_RESERVA if prioridad == 'fondo' else 0
+        with self._lock:
+            estado = self._estado[proveedor]
+            ahora = time.monotonic()
+            if ahora < estado['bloqueado_hasta']:
+                return estado['bloqueado_hasta'] - ahora
+            if estado['restantes'] is not None and ahora < estado['reinicio']:
+                if estado['restantes'] <= minimo:
+                    return estado['reinicio'] - ahora
+                estado['restantes'] -= 1
+            return 0
+
+    def reservar(self, proveedor, prioridad='interactiva'):
+        """Consumir una unidad antes de llamar; espera si el reinicio está cerca o lanza CuotaAgotada"""
+        while True:
+            espera = self.intentar_reservar(proveedor, prioridad)
+            if espera <= 0:
+                return
+            if prioridad == 'fondo' or espera > CUOTA_ESPERA_MAX:
+                raise CuotaAgotada(proveedor, espera)
+            time.sleep(espera)
+
+    def actualizar(self, proveedor, response):
+        """Aprender restantes y reinicio de las cabeceras de la respuesta"""
+        headers = response.headers
+        ahora = time.monotonic()
+        with self._lock:
+            estado = self._estado[proveedor]
+            
+            restantes = headers.get('X-RateLimit-Remaining')
+            reinicio = headers.get('X-RateLimit-Reset')
+            if restantes is not None:
+                try:
+                    estado['restantes'] = int(float(restantes))
+                    segundos = float(reinicio) if reinicio is not None else 60
+                    # GitHub manda un epoch; Reddit, segundos hasta el reinicio
+                    if segundos > 1e9:
+                        segundos -= time.time()
+                    estado['reinicio'] = ahora + max(segundos, 0)
+                except ValueError:
+                    pass
+            
+            if response.status_code in (429, 503) or (response.status_code == 403 and estado['restantes'] == 0):
+                retry_after = segundos_retry_after(headers.get('Retry-After'))
+                if retry_after is None and response.status_code != 503:
+                    retry_after = max(estado['reinicio'] - ahora, CUOTA_BLOQUEO_429)
+                if retry_after:
+                    estado['bloqueado_hasta'] = ahora + retry_after
+
+    def espera(self, proveedor):
+        """Segundos que el proveedor seguirá bloqueado"""
+        with self._lock:
+            return max(self._estado[proveedor]['bloqueado_hasta'] - time.monotonic(), 0)
+
+    def estado(self):
+        ahora = time.monotonic()
+        with self._lock:
+            return {
+                proveedor: {
+                    'restantes': estado['restantes'],
+                    'reinicio_en': round(max(estado['reinicio'] - ahora, 0), 1) if estado['restantes'] is not None else None,
+                    'bloqueado_por': round(max(estado['bloqueado_hasta'] - ahora, 0), 1)
+                }
+                for proveedor, estado in self._estado.items()
+            }
+
+cuotas_upstream = CuotasUpstream()
+
+class ErrorConsulta(Exception):
+    """Resultado de una consulta que no es un fallo del proveedor (p. ej. ubicación o subreddit inexistente)"""
+    
+    def __init__(self, mensaje, codigo=400):
+        super().__init__(mensaje)
+        self.codigo = codigo
+
+def descripcion_error(e):
+    """Cuerpo, código y cabeceras para un error al consultar una API externa"""
+    if isinstance(e, ErrorConsulta):
+        return {'error': str(e)}, e.codigo, {}
+    if isinstance(e, UpstreamNoDisponible):
+        espera = math.ceil(e.retry_after)
+        return {'error': str(e), 'reintentar_en': espera}, 503, {'Retry-After': str(espera)}
+    if isinstance(e, (requests.Timeout, asyncio.TimeoutError)):
+        return {'error': 'La API externa no respondió a tiempo'}, 504, {}
+    return {'error': str(e)}, 500, {}
+
+def error_upstream(e):
+    """Respuesta HTTP para un error al consultar una API externa"""
+    datos, codigo, cabeceras = descripcion_error(e)
+    respuesta = jsonify(datos)
+    respuesta.headers.update(cabeceras)
+    return respuesta, codigo
+
+# ==================== CIRCUIT BREAKER Y BULKHEAD ====================
+CIRCUITO_FALLOS = int(os.getenv('CIRCUITO_FALLOS', 5))
+CIRCUITO_ABIERTO = float(os.getenv('CIRCUITO_ABIERTO', 30))
+BULKHEAD_ESPERA = float(os.getenv('BULKHEAD_ESPERA', 0.1))
+
+# Proveedor: (peticiones simultáneas, segundos a partir de los que una respuesta cuenta como fallo por lenta)
+LIMITES_UPSTREAM = {
+    'spotify': (10, 5),
+    'tmdb': (10, 5),
+    'openweather': (8, 4),
+    'ipapi': (8, 4),
+    'exchange': (4, 8),
+    'github': (8, 5),
+    'books': (8, 6),
+    'reddit': (8, 6),
+    'overpass': (4, 25)
+}
+
+class CircuitoAbierto(UpstreamNoDisponible):
+    mensaje = '{proveedor} no responde correctamente; circuito abierto'
+
+class ProveedorSaturado(UpstreamNoDisponible):
+    mensaje = 'Demasiadas peticiones simultáneas a {proveedor}'
+
+class Circuito:
+    """Circuit breaker y bulkhead de un proveedor: cerrado, abierto o semiabierto (una sonda a la vez)"""
+
+    def __init__(self, proveedor):
+        concurrencia, latencia_lenta = LIMITES_UPSTREAM.get(proveedor, (8, 10))
+        self.proveedor = proveedor
+        self.concurrencia = int(os.getenv(f'BULKHEAD_{proveedor.upper()}', concurrencia))
+        self.latencia_lenta = float(os.getenv(f'LATENCIA_LENTA_{proveedor.upper()}', latencia_lenta))
+        self.bulkhead = threading.BoundedSemaphore(self.concurrencia)
+        self._lock = threading.Lock()
+        self.estado = 'cerrado'
+        self.fallos = 0
+        self.abierto_hasta = 0
+        self.sonda_en_curso = False
+        self.contadores = Counter()
+
+    def permitir(self):
+        """Lanza CircuitoAbierto si no se debe llamar; en semiabierto deja pasar una sola sonda"""
+        with self._lock:
+            ahora = time.monotonic()
+            if self.estado == 'abierto':
+                if ahora < self.abierto_hasta:
+                    self.contadores['rechazadas'] += 1
+                    raise CircuitoAbierto(self.proveedor, self.abierto_hasta - ahora)
+                self.estado = 'semiabierto'
+            if self.estado == 'semiabierto':
+                if self.sonda_en_curso:
+                    self.contadores['rechazadas'] += 1
+                    raise CircuitoAbierto(self.proveedor, 1)
+                self.sonda_en_curso = True
+
+    def contar(self, evento):
+        with self._lock:
+            self.contadores[evento] += 1
+
+    def cancelar(self):
+        """La llamada permitida no llegó a hacerse (cuota o bulkhead)"""
+        with self._lock:
+            self.sonda_en_curso = False
+
+    def registrar(self, exito):
+        with self._lock:
+            self.sonda_en_curso = False
+            if exito:
+                self.contadores['exitos'] += 1
+                self.fallos = 0
+                self.estado = 'cerrado'
+                return
+            self.contadores['fallos'] += 1
+            self.fallos += 1
+            if self.estado == 'semiabierto' or self.fallos >= CIRCUITO_FALLOS:
+                self.estado = 'abierto'
+                self.abierto_hasta = time.monotonic() + CIRCUITO_ABIERTO
+                self.contadores['aperturas'] += 1
+
+    def resumen(self):
+        with self._lock:
+            return {
+                'estado': self.estado,
+                'fallos_consecutivos': self.fallos,
+                'abierto_por': round(max(self.abierto_hasta - time.monotonic(), 0), 1) if self.estado == 'abierto' else 0,
+                'concurrencia_max': self.concurrencia,
+                'latencia_lenta': self.latencia_lenta,
+                'contadores': dict(self.contadores)
+            }
+
+circuitos_upstream = {}
+_circuitos_lock = threading.Lock()
+
+def circuito_de(proveedor):
+    with _circuitos_lock:
+        if proveedor not in circuitos_upstream:
+            circuitos_upstream[proveedor] = Circuito(proveedor)
+        return circuitos_upstream[proveedor]
+
+# ==================== CACHE DE RESPUESTAS EXTERNAS ====================
+# Máximo de entradas para los proveedores sin límite propio en POLITICAS_CACHE
+CACHE_MAX_ENTRADAS = int(os.getenv('CACHE_MAX_ENTRADAS', 500))
+
+# Política por proveedor: (segundos frescos, segundos extra en los que se sirve stale mientras se refresca,
+# máximo de entradas). Cada proveedor tiene su propio LRU: muchas IPs distintas en ipapi no expulsan
+# las tiles de Overpass ni los ETags de GitHub.
+POLITICAS_CACHE = {
+    'spotify': (300, 900, 500),
+    'tmdb': (900, 3600, 500),
+    'openweather': (300, 600, 500),
+    'ipapi': (3600, 3600, 2000),
+    'exchange': (3600, 3600, 50),
+    'github': (300, 1800, 500),
+    'books': (1800, 3600, 300),
+    'reddit': (60, 120, 200),
+    'overpass': (3600, 86400, 2000)
 }
 
+def politica_cache(proveedor):
+    """TTL y ventana stale del proveedor; se pueden ajustar con CACHE_TTL_<PROVEEDOR> y CACHE_STALE_<PROVEEDOR>"""
+    ttl, stale, _ = POLITICAS_CACHE.get(proveedor, (60, 0, CACHE_MAX_ENTRADAS))
+    ttl = float(os.getenv(f'CACHE_TTL_{proveedor.upper()}', ttl))
+    stale = float(os.getenv(f'CACHE_STALE_{proveedor.upper()}', stale))
+    return ttl, stale
+
+def limite_cache(proveedor):
+    """Máximo de entradas del proveedor; se puede ajustar con CACHE_MAX_<PROVEEDOR>"""
+    _, _, maximo = POLITICAS_CACHE.get(proveedor, (60, 0, CACHE_MAX_ENTRADAS))
+    return int(os.getenv(f'CACHE_MAX_{proveedor.upper()}', maximo))
+
+class RespuestaCacheada:
+    """Respuesta ya leída de una API externa; expone status_code y json() como requests.Response"""
+    __slots__ = ('status_code', 'headers', 'datos')
+
+    def __init__(self, status_code, headers, datos):
+        self.status_code = status_code
+        self.headers = headers
+        self.datos = datos
+
+    def json(self):
+        if self.datos is None:
+            raise ValueError('La respuesta no contiene JSON')
+        return self.datos
+
+class CacheTTL:
+    """Cache LRU acotada por proveedor, con expiración por entrada y contadores por proveedor"""
+
+    def __init__(self, max_entradas_de):
+        self.max_entradas_de = max_entradas_de  # proveedor -> máximo de entradas
+        self._entradas = defaultdict(OrderedDict)  # proveedor -> clave -> (valor, fresco_hasta, stale_hasta, revalidable)
+        self._lock = threading.Lock()
+        self._stats = defaultdict(Counter)
+
+    def obtener(self, clave, proveedor):
+        """Devuelve (valor, estado) con estado 'fresco', 'stale', 'revalidar' o None si no hay entrada útil"""
+        ahora = time.monotonic()
+        with self._lock:
+            entradas = self._entradas[proveedor]
+            entrada = entradas.get(clave)
+            if entrada is None:
+                self._stats[proveedor]['misses'] += 1
+                return None, None
+            valor, fresco_hasta, stale_hasta, revalidable = entrada
+            if ahora < fresco_hasta:
+                entradas.move_to_end(clave)
+                self._stats[proveedor]['hits'] += 1
+                return valor, 'fresco'
+            if ahora < stale_hasta:
+                entradas.move_to_end(clave)
+                self._stats[proveedor]['stale_hits'] += 1
+                return valor, 'stale'
+            if revalidable:
+                # Expirada pero con ETag: se conserva para una petición condicional
+                self._stats[proveedor]['revalidaciones'] += 1
+                return valor, 'revalidar'
+            del entradas[clave]
+            self._stats[proveedor]['expirados'] += 1
+            self._stats[proveedor]['misses'] += 1
+            return None, None
+
+    def guardar(self, clave, proveedor, valor, ttl, stale=0, revalidable=False):
+        ahora = time.monotonic()
+        maximo = self.max_entradas_de(proveedor)
+        with self._lock:
+            entradas = self._entradas[proveedor]
+            entradas[clave] = (valor, ahora + ttl, ahora + ttl + stale, revalidable)
+            entradas.move_to_end(clave)
+            while len(entradas) > maximo:
+                entradas.popitem(last=False)
+                self._stats[proveedor]['evictions'] += 1
+
+    def contar(self, proveedor, evento):
+        with self._lock:
+            self._stats[proveedor][evento] += 1
+
+    def estadisticas(self):
+        with self._lock:
+            por_proveedor = {
+                proveedor: dict(contadores, entradas=len(self._entradas[proveedor]))
+                for proveedor, contadores in self._stats.items()
+            }
+            return {
+                'entradas': sum(len(entradas) for entradas in self._entradas.values()),
+                'proveedores': por_proveedor
+            }
+
+cache_upstream = CacheTTL(limite_cache)
+_refrescos_en_curso = set()
+_refrescos_lock = threading.Lock()
+
+def clave_cache(method, url, params=None):
+    """Clave normalizada: método, URL sin query y parámetros ordenados (incluidos los de la URL)"""
+    partes = urlsplit(url)
+    pares = parse_qsl(partes.query, keep_blank_values=True)
+    if params:
+        pares.extend((k, v) for k, v in params.items() if v is not None)
+    query = urlencode(sorted((str(k), str(v)) for k, v in pares))
+    return f"{method.upper()} {partes.scheme}://{partes.netloc.lower()}{partes.path}?{query}"
+
+class SingleFlight:
+    """Agrupa llamadas idénticas concurrentes: una sola ejecuta y las demás esperan su resultado"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_vuelo = {}  # clave -> {'evento', 'resultado', 'error'}
+
+    def hacer(self, clave, funcion):
+        """Devuelve (resultado, compartido); compartido es True si se reutilizó una llamada en vuelo"""
+        with self._lock:
+            vuelo = self._en_vuelo.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = {'evento': threading.Event(), 'resultado': None, 'error': None}
+                self._en_vuelo[clave] = vuelo
+        
+        if not lider:
+            vuelo['evento'].wait()
+            if vuelo['error'] is not None:
+                raise vuelo['error']
+            return vuelo['resultado'], True
+        
+        try:
+            vuelo['resultado'] = funcion()
+        except Exception as e:
+            vuelo['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._en_vuelo[clave]
+            vuelo['evento'].set()
+        return vuelo['resultado'], False
+
+upstream_vuelos = SingleFlight()
+
+def cabeceras_revalidacion(headers, anterior):
+    """Cabeceras de la petición con If-None-Match si hay copia anterior con ETag; devuelve (cabeceras, etag)"""
+    etag = anterior.headers.get('ETag') if anterior is not None else None
+    return (dict(headers or {}, **{'If-None-Match': etag}) if etag else headers), etag
+
+def guardar_respuesta_json(proveedor, clave, response, anterior, etag):
+    """Convertir la respuesta del proveedor en RespuestaCacheada y cachearla si es definitiva"""
+    if response.status_code == 429 or (response.status_code == 403 and response.headers.get('X-RateLimit-Remaining') == '0'):
+        raise CuotaAgotada(proveedor, cuotas_upstream.espera(proveedor))
+    ttl, stale = politica_cache(proveedor)
+    
+    # 304: lo guardado sigue vigente y no consume cuota (p. ej. GitHub)
+    if response.status_code == 304 and etag:
+        cache_upstream.guardar(clave, proveedor, anterior, ttl, stale, revalidable=True)
+        cache_upstream.contar(proveedor, 'no_modificados')
+        return anterior
+    
+    try:
+        datos = response.json()
+    except ValueError:
+        datos = None
+    resultado = RespuestaCacheada(response.status_code, CaseInsensitiveDict(response.headers), datos)
+    # Solo se guardan respuestas definitivas; los errores transitorios vuelven a consultarse
+    if response.status_code in (200, 404) and datos is not None:
+        revalidable = 'ETag' in resultado.headers
+        cache_upstream.guardar(clave, proveedor, resultado, ttl, stale, revalidable=revalidable)
+    return resultado
+
+def _descargar_json(proveedor, clave, url, params, headers, timeout, anterior=None, prioridad='interactiva'):
+    def descargar():
+        headers_peticion, etag = cabeceras_revalidacion(headers, anterior)
+        response = upstream_get(
+            url, params=params, headers=headers_peticion, timeout=timeout,
+            proveedor=proveedor, prioridad=prioridad
+        )
+        return guardar_respuesta_json(proveedor, clave, response, anterior, etag)
+    
+    # Peticiones idénticas simultáneas comparten una única descarga
+    resultado, compartido = upstream_vuelos.hacer(clave, descargar)
+    if compartido:
+        cache_upstream.contar(proveedor, 'coalescidas')
+    return resultado
+
+def _refrescar_en_segundo_plano(proveedor, clave, url, params, headers, timeout, anterior=None):
+    with _refrescos_lock:
+        if clave in _refrescos_en_curso:
+            return
+        _refrescos_en_curso.add(clave)
+
+    def tarea():
+        try:
+            _descargar_json(proveedor, clave, url, params, headers, timeout, anterior, prioridad='fondo')
+            cache_upstream.contar(proveedor, 'refrescos')
+        except Exception as e:
+            print(f"Error refrescando cache de {proveedor}: {e}")
+        finally:
+            with _refrescos_lock:
+                _refrescos_en_curso.discard(clave)
+
+    upstream_executor.submit(tarea)
+
+def upstream_json(proveedor, url, params=None, headers=None, timeout=None):
+    """GET a una API externa pasando por la cache de respuestas del proveedor"""
+    clave = clave_cache('GET', url, params)
+    valor, estado = cache_upstream.obtener(clave, proveedor)
+    if estado == 'fresco':
+        return valor
+    if estado == 'stale':
+        # Stale-while-revalidate: se responde con lo guardado y se refresca sin bloquear
+        _refrescar_en_segundo_plano(proveedor, clave, url, params, headers, timeout, valor)
+        return valor
+    try:
+        return _descargar_json(proveedor, clave, url, params, headers, timeout, valor)
+    except UpstreamNoDisponible:
+        # Sin cuota o con el circuito abierto, una copia caducada es mejor que un error
+        if valor is not None:
+            cache_upstream.contar(proveedor, 'servidos_degradado')
+            return valor
+        raise
+
+# ==================== COMPRESIÓN Y ETAGS ====================
+COMPRESION_MINIMO = int(os.getenv('COMPRESION_MINIMO', 1024))
+COMPRESION_NIVEL = int(os.getenv('COMPRESION_NIVEL', 6))
+MIMETYPES_COMPRIMIBLES = {'application/json', 'text/html'}
+
+def codificacion_para(accept_encoding):
+    """Mejor codificación que admite una cabecera Accept-Encoding: br (si está instalado), gzip o None"""
+    ofrecidas = ['br', 'gzip'] if brotli else ['gzip']
+    return parse_accept_header(accept_encoding).best_match(ofrecidas)
+
+def codificacion_negociada():
+    return codificacion_para(request.headers.get('Accept-Encoding'))
+
+def comprimir(cuerpo, codificacion):
+    if codificacion == 'br':
+        return brotli.compress(cuerpo, quality=COMPRESION_NIVEL)
+    if codificacion == 'gzip':
+        return gzip.compress(cuerpo, compresslevel=COMPRESION_NIVEL)
+    return cuerpo
+
+def etag_representacion(base, codificacion):
+    """Cada codificación es una representación distinta y lleva su propio ETag fuerte"""
+    return f'{base}-{codificacion}' if codificacion else base
+
+def etag_coincide_con(if_none_match, base):
+    """Una cabecera If-None-Match coincide con el ETag base en cualquiera de sus codificaciones"""
+    etiquetas = parse_etags(if_none_match)
+    if etiquetas.star_tag:
+        return True
+    for etiqueta in etiquetas.as_set():
+        if etiqueta == base or etiqueta.rsplit('-', 1)[0] == base:
+            return True
+    return False
+
+def etag_coincide(base):
+    return etag_coincide_con(request.headers.get('If-None-Match'), base)
+
+def no_modificado(base):
+    """Respuesta 304 sin cuerpo con el ETag de la representación que se habría enviado"""
+    respuesta = Response(status=304)
+    respuesta.set_etag(etag_representacion(base, codificacion_negociada()))
+    respuesta.vary.add('Accept-Encoding')
+    return respuesta
+
+@app.after_request
+def comprimir_y_validar(respuesta):
+    """ETag fuerte sobre el cuerpo (304 si el cliente ya lo tiene) y compresión según Accept-Encoding"""
+    if (respuesta.direct_passthrough or respuesta.is_streamed
+            or respuesta.mimetype not in MIMETYPES_COMPRIMIBLES
+            or 'Content-Encoding' in respuesta.headers):
+        return respuesta
+    
+    cuerpo = respuesta.get_data()
+    base = None
+    if request.method in ('GET', 'HEAD') and respuesta.status_code == 200:
+        base = respuesta.get_etag()[0] or hashlib.blake2b(cuerpo, digest_size=16).hexdigest()
+        if etag_coincide(base):
+            return no_modificado(base)
+    
+    codificacion = codificacion_negociada() if len(cuerpo) >= COMPRESION_MINIMO else None
+    respuesta.vary.add('Accept-Encoding')
+    if codificacion:
+        respuesta.set_data(comprimir(cuerpo, codificacion))
+        respuesta.headers['Content-Encoding'] = codificacion
+    if base:
+        respuesta.set_etag(etag_representacion(base, codificacion))
+    return respuesta
+
 # ==================== PÁGINA PRINCIPAL ====================
 @app.route('/')
 def index():
@@ -93,120 +779,219 @@ def reddit():
 def chat():
     return render_template('chat.html')
 
-# ==================== SPOTIFY API ====================
-def get_spotify_token():
-    """Obtener token de Spotify con cache"""
-    if _token_cache['access_token'] and _token_cache['expiry']:
-        if datetime.now() < _token_cache['expiry']:
-            return _token_cache['access_token']
+# ==================== PROYECCIONES (?fields=) ====================
+PROYECCION_MAX_PLANES = 256
+
+def primera_imagen(objeto):
+    """URL de la primera imagen de un objeto de Spotify, si tiene"""
+    imagenes = objeto.get('images')
+    return imagenes[0].get('url') if imagenes else None
+
+class Proyeccion:
+    """Campos que expone un recurso externo; el plan de extracción se compila una vez por conjunto de campos"""
     
-    auth_string = f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}"
-    auth_base64 = base64.b64encode(auth_string.encode()).decode()
+    def __init__(self, extractores):
+        self.extractores = extractores
+        self.planes = {}
     
-    headers = {
-        'Authorization': f'Basic {auth_base64}',
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
+    def plan(self, campos):
+        """Tupla (campo, extractor) para los campos pedidos (None = todos); ValueError si alguno no existe"""
+        plan = self.planes.get(campos)
+        if plan is not None:
+            return plan
+        
+        if campos is None:
+            plan = tuple(self.extractores.items())
+        else:
+            desconocidos = campos - self.extractores.keys()
+            if desconocidos:
+                raise ValueError(f"Campos desconocidos: {', '.join(sorted(desconocidos))}. "
+                                 f"Disponibles: {', '.join(self.extractores)}")
+            plan = tuple((campo, extraer) for campo, extraer in self.extractores.items() if campo in campos)
+        
+        if len(self.planes) < PROYECCION_MAX_PLANES:
+            self.planes[campos] = plan
+        return plan
     
+    def aplicar(self, plan, elementos):
+        return [{campo: extraer(elemento) for campo, extraer in plan} for elemento in elementos]
+
+def campos_pedidos(args=None):
+    """Conjunto de ?fields= separado por comas, o None si se piden todos"""
+    valor = (request.args if args is None else args).get('fields')
+    if not valor:
+        return None
+    return frozenset(campo.strip() for campo in valor.split(',') if campo.strip()) or None
+
+def plan_pedido(proyeccion, args):
+    """Plan de la proyección para ?fields=; un campo desconocido es un error 400"""
     try:
-        response = requests.post(SPOTIFY_TOKEN_URL, headers=headers, data={'grant_type': 'client_credentials'}, timeout=10)
-        if response.status_code == 200:
-            token_data = response.json()
-            _token_cache['access_token'] = token_data['access_token']
-            _token_cache['expiry'] = datetime.now() + timedelta(seconds=token_data['expires_in'] - 60)
-            return token_data['access_token']
-    except Exception as e:
-        print(f"Error obteniendo token Spotify: {e}")
+        return proyeccion.plan(campos_pedidos(args))
+    except ValueError as e:
+        raise ErrorConsulta(str(e), 400)
+
+# ==================== SPOTIFY API ====================
+def _programar_refresco_token(segundos):
+    """Programar la próxima renovación del token en un hilo de fondo"""
+    if _token_cache['timer'] is not None:
+        _token_cache['timer'].cancel()
+    timer = threading.Timer(max(segundos, 1), _refrescar_token_spotify, kwargs={'forzar': True})
+    timer.daemon = True
+    _token_cache['timer'] = timer
+    timer.start()
+
+def _refrescar_token_spotify(forzar=False):
+    """Pedir un token nuevo; solo un hilo a la vez y con backoff exponencial si falla"""
+    with _token_refresco_lock:
+        ahora = time.monotonic()
+        if not forzar:
+            # Otro hilo ya lo renovó o estamos en backoff mientras esperábamos el lock
+            if _token_cache['access_token'] and ahora < _token_cache['refrescar_en']:
+                return
+            if ahora < _token_cache['reintentar_en']:
+                return
+        
+        auth_string = f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}"
+        auth_base64 = base64.b64encode(auth_string.encode()).decode()
+        
+        headers = {
+            'Authorization': f'Basic {auth_base64}',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        
+        retry_after = 0
+        try:
+            response = upstream_post(SPOTIFY_TOKEN_URL, headers=headers, data={'grant_type': 'client_credentials'})
+            if response.status_code == 200:
+                token_data = response.json()
+                expires_in = token_data['expires_in']
+                ahora = time.monotonic()
+                refrescar_en = ahora + max(expires_in - SPOTIFY_TOKEN_MARGEN, expires_in / 2)
+                _token_cache.update({
+                    'access_token': token_data['access_token'],
+                    'expiry': ahora + expires_in - 60,
+                    'refrescar_en': refrescar_en,
+                    'fallos': 0,
+                    'reintentar_en': 0
+                })
+                _programar_refresco_token(refrescar_en - ahora)
+                return
+            if response.status_code == 429:
+                retry_after = float(response.headers.get('Retry-After', 0) or 0)
+            print(f"Error obteniendo token Spotify: HTTP {response.status_code}")
+        except Exception as e:
+            print(f"Error obteniendo token Spotify: {e}")
+        
+        fallos = _token_cache['fallos'] + 1
+        espera = max(retry_after, min(SPOTIFY_TOKEN_BACKOFF_MAX, 2 ** fallos))
+        _token_cache.update({'fallos': fallos, 'reintentar_en': time.monotonic() + espera})
+        _programar_refresco_token(espera)
+
+def get_spotify_token():
+    """Obtener token de Spotify con cache; se renueva en segundo plano antes de expirar"""
+    token = _token_cache['access_token']
+    if token and time.monotonic() < _token_cache['expiry']:
+        return token
+    
+    # Sin token válido (arranque o fallos prolongados): no insistir mientras dure el backoff
+    if time.monotonic() < _token_cache['reintentar_en']:
+        return None
+    
+    _refrescar_token_spotify()
+    token = _token_cache['access_token']
+    if token and time.monotonic() < _token_cache['expiry']:
+        return token
     return None
 
+def duracion_texto(ms):
+    return f"{ms // 60000}:{(ms % 60000) // 1000:02d}"
+
+# Proyección de cada tipo de resultado de /search
+PROYECCIONES_SPOTIFY = {
+    'track': Proyeccion({
+        'id': lambda t: t.get('id'),
+        'nombre': lambda t: t.get('name', 'Sin título'),
+        'artistas': lambda t: [a.get('name', '') for a in t.get('artists', [])],
+        'artista_principal': lambda t: t['artists'][0].get('name', '') if t.get('artists') else '',
+        'album': lambda t: t.get('album', {}).get('name', 'Sin álbum'),
+        'imagen': lambda t: primera_imagen(t.get('album', {})),
+        'duracion_ms': lambda t: t.get('duration_ms', 0),
+        'duracion': lambda t: duracion_texto(t.get('duration_ms', 0)),
+        'preview_url': lambda t: t.get('preview_url'),
+        'spotify_url': lambda t: t.get('external_urls', {}).get('spotify', ''),
+        'popularidad': lambda t: t.get('popularity', 0),
+        'explicito': lambda t: t.get('explicit', False)
+    }),
+    'artist': Proyeccion({
+        'id': lambda a: a.get('id'),
+        'nombre': lambda a: a.get('name', 'Sin nombre'),
+        'generos': lambda a: a.get('genres', []),
+        'popularidad': lambda a: a.get('popularity', 0),
+        'imagen': primera_imagen,
+        'seguidores': lambda a: a.get('followers', {}).get('total', 0),
+        'spotify_url': lambda a: a.get('external_urls', {}).get('spotify', '')
+    }),
+    'album': Proyeccion({
+        'id': lambda a: a.get('id'),
+        'nombre': lambda a: a.get('name', 'Sin título'),
+        'artistas': lambda a: [artista.get('name', '') for artista in a.get('artists', [])],
+        'fecha_lanzamiento': lambda a: a.get('release_date', ''),
+        'total_tracks': lambda a: a.get('total_tracks', 0),
+        'imagen': primera_imagen,
+        'spotify_url': lambda a: a.get('external_urls', {}).get('spotify', ''),
+        'tipo': lambda a: a.get('album_type', 'album')
+    }),
+    'playlist': Proyeccion({
+        'id': lambda p: p.get('id'),
+        'nombre': lambda p: p.get('name', 'Sin nombre'),
+        'descripcion': lambda p: p.get('description', ''),
+        'owner': lambda p: p.get('owner', {}).get('display_name', 'Desconocido'),
+        'total_tracks': lambda p: p.get('tracks', {}).get('total', 0),
+        'imagen': primera_imagen,
+        'spotify_url': lambda p: p.get('external_urls', {}).get('spotify', ''),
+        'publica': lambda p: p.get('public', True)
+    })
+}
+
 @app.route('/api/spotify/buscar')
 def buscar_spotify():
-    query = request.args.get('q', '')
-    tipo = request.args.get('tipo', 'track')
-    limite = int(request.args.get('limite', 10))
+    try:
+        params, tipo, plan = busqueda_spotify(request.args)
+        response = upstream_json(**consulta_spotify(params, get_spotify_token()))
+        return jsonify(resultado_spotify(response, tipo, plan))
+    except Exception as e:
+        return error_upstream(e)
+
+def busqueda_spotify(args):
+    """Validar los parámetros de /api/spotify/buscar; devuelve (params de /search, tipo, plan)"""
+    query = args.get('q', '')
+    tipo = args.get('tipo', 'track')
+    limite = int(args.get('limite', 10))
     
     if not query:
-        return jsonify({'error': 'Consulta requerida'}), 400
+        raise ErrorConsulta('Consulta requerida', 400)
     
-    token = get_spotify_token()
+    proyeccion = PROYECCIONES_SPOTIFY.get(tipo)
+    plan = plan_pedido(proyeccion, args) if proyeccion else None
+    return {'q': query, 'type': tipo, 'limit': limite, 'market': 'MX'}, tipo, plan
+
+def consulta_spotify(params, token):
     if not token:
-        return jsonify({'error': 'Error al autenticar con Spotify'}), 500
-    
-    try:
-        response = requests.get(
-            f'{SPOTIFY_API_URL}/search',
-            headers={'Authorization': f'Bearer {token}'},
-            params={'q': query, 'type': tipo, 'limit': limite, 'market': 'MX'},
-            timeout=10
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': f'Error de Spotify API: {response.status_code}'}), 500
-        
-        data = response.json()
-        resultados = []
-        
-        if tipo == 'track':
-            for track in data.get('tracks', {}).get('items', []):
-                album = track.get('album', {})
-                artists = track.get('artists', [])
-                resultados.append({
-                    'id': track.get('id'),
-                    'nombre': track.get('name', 'Sin título'),
-                    'artistas': [a.get('name', '') for a in artists],
-                    'artista_principal': artists[0].get('name', '') if artists else '',
-                    'album': album.get('name', 'Sin álbum'),
-                    'imagen': album.get('images', [{}])[0].get('url') if album.get('images') else None,
-                    'duracion_ms': track.get('duration_ms', 0),
-                    'duracion': f"{track.get('duration_ms', 0) // 60000}:{(track.get('duration_ms', 0) % 60000) // 1000:02d}",
-                    'preview_url': track.get('preview_url'),
-                    'spotify_url': track.get('external_urls', {}).get('spotify', ''),
-                    'popularidad': track.get('popularity', 0),
-                    'explicito': track.get('explicit', False)
-                })
-        
-        elif tipo == 'artist':
-            for artist in data.get('artists', {}).get('items', []):
-                resultados.append({
-                    'id': artist.get('id'),
-                    'nombre': artist.get('name', 'Sin nombre'),
-                    'generos': artist.get('genres', []),
-                    'popularidad': artist.get('popularity', 0),
-                    'imagen': artist.get('images', [{}])[0].get('url') if artist.get('images') else None,
-                    'seguidores': artist.get('followers', {}).get('total', 0),
-                    'spotify_url': artist.get('external_urls', {}).get('spotify', '')
-                })
-        
-        elif tipo == 'album':
-            for album in data.get('albums', {}).get('items', []):
-                artists = album.get('artists', [])
-                resultados.append({
-                    'id': album.get('id'),
-                    'nombre': album.get('name', 'Sin título'),
-                    'artistas': [a.get('name', '') for a in artists],
-                    'fecha_lanzamiento': album.get('release_date', ''),
-                    'total_tracks': album.get('total_tracks', 0),
-                    'imagen': album.get('images', [{}])[0].get('url') if album.get('images') else None,
-                    'spotify_url': album.get('external_urls', {}).get('spotify', ''),
-                    'tipo': album.get('album_type', 'album')
-                })
-        
-        elif tipo == 'playlist':
-            for playlist in data.get('playlists', {}).get('items', []):
-                resultados.append({
-                    'id': playlist.get('id'),
-                    'nombre': playlist.get('name', 'Sin nombre'),
-                    'descripcion': playlist.get('description', ''),
-                    'owner': playlist.get('owner', {}).get('display_name', 'Desconocido'),
-                    'total_tracks': playlist.get('tracks', {}).get('total', 0),
-                    'imagen': playlist.get('images', [{}])[0].get('url') if playlist.get('images') else None,
-                    'spotify_url': playlist.get('external_urls', {}).get('spotify', ''),
-                    'publica': playlist.get('public', True)
-                })
-        
-        return jsonify(resultados)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        raise ErrorConsulta('Error al autenticar con Spotify', 500)
+    return {
+        'proveedor': 'spotify',
+        'url': f'{SPOTIFY_API_URL}/search',
+        'headers': {'Authorization': f'Bearer {token}'},
+        'params': params
+    }
+
+def resultado_spotify(response, tipo, plan):
+    if response.status_code != 200:
+        raise ErrorConsulta(f'Error de Spotify API: {response.status_code}', 500)
+    proyeccion = PROYECCIONES_SPOTIFY.get(tipo)
+    if proyeccion is None:
+        return []
+    return proyeccion.aplicar(plan, response.json().get(f'{tipo}s', {}).get('items', []))
 
 @app.route('/api/spotify/artista/<artist_id>')
 def info_artista_spotify(artist_id):
@@ -216,21 +1001,41 @@ def info_artista_spotify(artist_id):
     
     try:
         headers = {'Authorization': f'Bearer {token}'}
+        limite = time.monotonic() + SPOTIFY_ARTISTA_DEADLINE
+        
+        # Las cuatro peticiones salen a la vez; la latencia total es la de la más lenta
+        futuros = {
+            'artista': upstream_executor.submit(upstream_json, 'spotify', f'{SPOTIFY_API_URL}/artists/{artist_id}', headers=headers),
+            'top_canciones': upstream_executor.submit(upstream_json, 'spotify', f'{SPOTIFY_API_URL}/artists/{artist_id}/top-tracks', headers=headers, params={'market': 'MX'}),
+            'albums': upstream_executor.submit(upstream_json, 'spotify', f'{SPOTIFY_API_URL}/artists/{artist_id}/albums', headers=headers, params={'limit': 10, 'market': 'MX'}),
+            'artistas_relacionados': upstream_executor.submit(upstream_json, 'spotify', f'{SPOTIFY_API_URL}/artists/{artist_id}/related-artists', headers=headers)
+        }
         
-        artist_response = requests.get(f'{SPOTIFY_API_URL}/artists/{artist_id}', headers=headers, timeout=10)
+        try:
+            artist_response = futuros['artista'].result(timeout=max(0, limite - time.monotonic()))
+        except FuturesTimeout:
+            for futuro in futuros.values():
+                futuro.cancel()
+            return jsonify({'error': 'Tiempo de espera agotado al obtener artista'}), 504
         if artist_response.status_code != 200:
             return jsonify({'error': 'Error al obtener artista'}), 500
         
         artist = artist_response.json()
         
-        top_response = requests.get(f'{SPOTIFY_API_URL}/artists/{artist_id}/top-tracks', headers=headers, params={'market': 'MX'}, timeout=10)
-        top_tracks = top_response.json().get('tracks', [])
-        
-        albums_response = requests.get(f'{SPOTIFY_API_URL}/artists/{artist_id}/albums', headers=headers, params={'limit': 10, 'market': 'MX'}, timeout=10)
-        albums = albums_response.json().get('items', [])
+        # Las secciones secundarias que no lleguen antes del límite se marcan como parciales
+        parciales = []
+        secciones = {}
+        for seccion, clave in (('top_canciones', 'tracks'), ('albums', 'items'), ('artistas_relacionados', 'artists')):
+            respuesta = esperar_respuesta(futuros[seccion], limite)
+            if respuesta is None or respuesta.status_code != 200:
+                parciales.append(seccion)
+                secciones[seccion] = []
+            else:
+                secciones[seccion] = respuesta.json().get(clave, [])
         
-        related_response = requests.get(f'{SPOTIFY_API_URL}/artists/{artist_id}/related-artists', headers=headers, timeout=10)
-        related = related_response.json().get('artists', [])
+        top_tracks = secciones['top_canciones']
+        albums = secciones['albums']
+        related = secciones['artistas_relacionados']
         
         resultado = {
             'id': artist['id'],
@@ -271,12 +1076,13 @@ def info_artista_spotify(artist_id):
                     'popularidad': rel['popularity']
                 }
                 for rel in related[:6]
-            ]
+            ],
+            'parciales': parciales
         }
         
         return jsonify(resultado)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
 
 @app.route('/api/spotify/album/<album_id>')
 def info_album_spotify(album_id):
@@ -286,7 +1092,7 @@ def info_album_spotify(album_id):
     
     try:
         headers = {'Authorization': f'Bearer {token}'}
-        response = requests.get(f'{SPOTIFY_API_URL}/albums/{album_id}', headers=headers, params={'market': 'MX'}, timeout=10)
+        response = upstream_json('spotify', f'{SPOTIFY_API_URL}/albums/{album_id}', headers=headers, params={'market': 'MX'})
         
         if response.status_code != 200:
             return jsonify({'error': 'Error al obtener álbum'}), 500
@@ -318,70 +1124,74 @@ def info_album_spotify(album_id):
         
         return jsonify(resultado)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
 
 # ==================== PELÍCULAS API ====================
+PROYECCION_PELICULA = Proyeccion({
+    'id': lambda m: m['id'],
+    'titulo': lambda m: m['title'],
+    'titulo_original': lambda m: m['original_title'],
+    'descripcion': lambda m: m['overview'],
+    'poster': lambda m: f"{TMDB_IMAGE_BASE}{m['poster_path']}" if m.get('poster_path') else None,
+    'backdrop': lambda m: f"https://image.tmdb.org/t/p/original{m['backdrop_path']}" if m.get('backdrop_path') else None,
+    'fecha_estreno': lambda m: m.get('release_date', ''),
+    'popularidad': lambda m: m.get('popularity', 0),
+    'calificacion': lambda m: m.get('vote_average', 0),
+    'votos': lambda m: m.get('vote_count', 0)
+})
+
 @app.route('/api/peliculas/buscar')
 def buscar_peliculas():
-    query = request.args.get('q', '')
-    page = request.args.get('page', 1, type=int)
-    
-    if not query:
-        return jsonify({'error': 'Consulta requerida'}), 400
-    
     try:
-        response = requests.get(
-            f'{TMDB_BASE_URL}/search/movie',
-            params={
-                'api_key': TMDB_API_KEY,
-                'query': query,
-                'language': 'es-MX',
-                'page': page,
-                'include_adult': False
-            },
-            timeout=10
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': 'Error al buscar películas'}), 500
-        
-        data = response.json()
-        
-        peliculas = []
-        for movie in data.get('results', []):
-            peliculas.append({
-                'id': movie['id'],
-                'titulo': movie['title'],
-                'titulo_original': movie['original_title'],
-                'descripcion': movie['overview'],
-                'poster': f"{TMDB_IMAGE_BASE}{movie['poster_path']}" if movie.get('poster_path') else None,
-                'backdrop': f"https://image.tmdb.org/t/p/original{movie['backdrop_path']}" if movie.get('backdrop_path') else None,
-                'fecha_estreno': movie.get('release_date', ''),
-                'popularidad': movie.get('popularity', 0),
-                'calificacion': movie.get('vote_average', 0),
-                'votos': movie.get('vote_count', 0)
-            })
-        
-        return jsonify({
-            'peliculas': peliculas,
-            'pagina': data['page'],
-            'total_paginas': data['total_pages'],
-            'total_resultados': data['total_results']
-        })
+        consulta, plan = busqueda_peliculas(request.args)
+        return jsonify(resultado_busqueda_peliculas(upstream_json(**consulta), plan))
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
+
+def busqueda_peliculas(args):
+    """Validar los parámetros de /api/peliculas/buscar; devuelve (consulta a TMDB, plan)"""
+    query = args.get('q', '')
+    if not query:
+        raise ErrorConsulta('Consulta requerida', 400)
+    
+    plan = plan_pedido(PROYECCION_PELICULA, args)
+    consulta = {
+        'proveedor': 'tmdb',
+        'url': f'{TMDB_BASE_URL}/search/movie',
+        'params': {
+            'api_key': TMDB_API_KEY,
+            'query': query,
+            'language': 'es-MX',
+            'page': args.get('page', 1, type=int),
+            'include_adult': False
+        }
+    }
+    return consulta, plan
+
+def resultado_busqueda_peliculas(response, plan):
+    if response.status_code != 200:
+        raise ErrorConsulta('Error al buscar películas', 500)
+    
+    data = response.json()
+    
+    return {
+        'peliculas': PROYECCION_PELICULA.aplicar(plan, data.get('results', [])),
+        'pagina': data['page'],
+        'total_paginas': data['total_pages'],
+        'total_resultados': data['total_results']
+    }
 
 @app.route('/api/peliculas/<int:movie_id>')
 def detalle_pelicula(movie_id):
     try:
-        response = requests.get(
+        response = upstream_json(
+            'tmdb',
             f'{TMDB_BASE_URL}/movie/{movie_id}',
             params={
                 'api_key': TMDB_API_KEY,
                 'language': 'es-MX',
                 'append_to_response': 'credits,videos,similar'
-            },
-            timeout=10
+            }
         )
         
         if response.status_code == 404:
@@ -446,97 +1256,277 @@ def detalle_pelicula(movie_id):
         
         return jsonify(detalle)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
+
+def consulta_peliculas_populares(page):
+    return {
+        'proveedor': 'tmdb',
+        'url': f'{TMDB_BASE_URL}/movie/popular',
+        'params': {'api_key': TMDB_API_KEY, 'language': 'es-MX', 'page': page}
+    }
+
+def datos_peliculas_populares(page):
+    return resultado_peliculas_populares(upstream_json(**consulta_peliculas_populares(page)))
+
+def resultado_peliculas_populares(response):
+    data = response.json()
+    
+    peliculas = [
+        {
+            'id': movie['id'],
+            'titulo': movie['title'],
+            'poster': f"{TMDB_IMAGE_BASE}{movie['poster_path']}" if movie.get('poster_path') else None,
+            'calificacion': movie.get('vote_average', 0),
+            'fecha_estreno': movie.get('release_date', '')
+        }
+        for movie in data.get('results', [])
+    ]
+    
+    return {'peliculas': peliculas, 'pagina': data['page'], 'total_paginas': data['total_pages']}
 
 @app.route('/api/peliculas/populares')
 def peliculas_populares():
     page = request.args.get('page', 1, type=int)
     
     try:
-        response = requests.get(
-            f'{TMDB_BASE_URL}/movie/popular',
-            params={'api_key': TMDB_API_KEY, 'language': 'es-MX', 'page': page},
-            timeout=10
-        )
-        data = response.json()
-        
-        peliculas = [
-            {
-                'id': movie['id'],
-                'titulo': movie['title'],
-                'poster': f"{TMDB_IMAGE_BASE}{movie['poster_path']}" if movie.get('poster_path') else None,
-                'calificacion': movie.get('vote_average', 0),
-                'fecha_estreno': movie.get('release_date', '')
-            }
-            for movie in data.get('results', [])
-        ]
-        
-        return jsonify({'peliculas': peliculas, 'pagina': data['page'], 'total_paginas': data['total_pages']})
+        return jsonify(datos_peliculas_populares(page))
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
 
 # ==================== CLIMA API ====================
+def ip_real(remota, reenviada):
+    """IP del cliente; detrás de un proxy se toma la primera de X-Forwarded-For si CLIMA_CONFIAR_PROXY está activo"""
+    if CLIMA_CONFIAR_PROXY and reenviada:
+        return reenviada.split(',')[0].strip()
+    return remota or ''
+
+def ip_cliente():
+    return ip_real(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+def ip_geolocalizable(ip):
+    """Las IPs privadas o locales no se pueden geolocalizar; en ese caso ip-api usa la del servidor"""
+    try:
+        direccion = ipaddress.ip_address(ip)
+    except ValueError:
+        return ''
+    return '' if direccion.is_private or direccion.is_loopback else ip
+
+def celda_clima(lat, lon):
+    """Redondear a la celda de la rejilla para que usuarios cercanos compartan la misma consulta"""
+    return round(round(lat / CLIMA_GRID) * CLIMA_GRID, 4), round(round(lon / CLIMA_GRID) * CLIMA_GRID, 4)
+
+OPENWEATHER_URL = 'https://api.openweathermap.org/data/2.5/weather'
+
+def consulta_ubicacion(ip):
+    return {
+        'proveedor': 'ipapi',
+        'url': f'http://ip-api.com/json/{ip}',
+        'params': {'fields': 'status,message,country,city,lat,lon'},
+        'timeout': 5
+    }
+
+def consulta_clima(ubicacion):
+    """Consulta del clima de la celda de la ubicación; error si ip-api no pudo geolocalizar"""
+    if ubicacion.get('status') == 'fail':
+        raise ErrorConsulta('No se pudo obtener ubicación', 400)
+    
+    lat, lon = celda_clima(ubicacion.get('lat'), ubicacion.get('lon'))
+    return {
+        'proveedor': 'openweather',
+        'url': OPENWEATHER_URL,
+        'params': {'lat': lat, 'lon': lon, 'appid': WEATHER_API_KEY, 'units': 'metric', 'lang': 'es'},
+        'timeout': 5
+    }
+
+def datos_clima(ip):
+    """Clima de la celda en la que geolocaliza la IP (vacía = la del servidor)"""
+    # Ubicación cacheada por IP y clima cacheado por celda (ver POLITICAS_CACHE)
+    ubicacion = upstream_json(**consulta_ubicacion(ip)).json()
+    clima = upstream_json(**consulta_clima(ubicacion)).json()
+    return resultado_clima(ubicacion, clima)
+
+def resultado_clima(ubicacion, clima):
+    return {
+        'ciudad': ubicacion.get('city', 'Ciudad desconocida'),
+        'pais': ubicacion.get('country', 'Desconocido'),
+        'temperatura': round(clima['main']['temp'], 1),
+        'descripcion': clima['weather'][0]['description'].capitalize(),
+        'humedad': clima['main']['humidity'],
+        'viento': clima['wind']['speed'],
+        'icono': clima['weather'][0]['icon']
+    }
+
 @app.route('/api/clima')
 def obtener_clima():
     try:
-        ip_response = requests.get('http://ip-api.com/json/', timeout=5)
-        ubicacion = ip_response.json()
-        
-        if ubicacion.get('status') == 'fail':
-            return jsonify({'error': 'No se pudo obtener ubicación'}), 400
-        
-        ciudad = ubicacion.get('city', 'Ciudad desconocida')
-        lat = ubicacion.get('lat')
-        lon = ubicacion.get('lon')
-        
-        clima_response = requests.get(
-            'https://api.openweathermap.org/data/2.5/weather',
-            params={'lat': lat, 'lon': lon, 'appid': WEATHER_API_KEY, 'units': 'metric', 'lang': 'es'},
-            timeout=5
-        )
-        clima = clima_response.json()
-        
-        resultado = {
-            'ciudad': ciudad,
-            'pais': ubicacion.get('country', 'Desconocido'),
-            'temperatura': round(clima['main']['temp'], 1),
-            'descripcion': clima['weather'][0]['description'].capitalize(),
-            'humedad': clima['main']['humidity'],
-            'viento': clima['wind']['speed'],
-            'icono': clima['weather'][0]['icon']
-        }
-        
-        return jsonify(resultado)
+        return jsonify(datos_clima(ip_geolocalizable(ip_cliente())))
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
 
 # ==================== DIVISAS API ====================
-@app.route('/api/divisas/convertir')
-def convertir_divisas():
-    monto = request.args.get('monto', type=float)
-    de = request.args.get('de', 'USD').upper()
-    a = request.args.get('a', 'MXN').upper()
-    
-    if not monto:
-        return jsonify({'error': 'Monto requerido'}), 400
-    
+# Tabla de tasas en memoria respecto a DIVISAS_BASE (tiempos en time.monotonic)
+_tabla_divisas = {
+    'base': None,
+    'tasas': {},
+    'actualizado': None,
+    'siguiente_refresco': 0,
+    'timer': None
+}
+_tabla_divisas_lock = threading.Lock()
+
+def _programar_refresco_divisas(segundos):
+    if _tabla_divisas['timer'] is not None:
+        _tabla_divisas['timer'].cancel()
+    timer = threading.Timer(max(segundos, 1), actualizar_tabla_divisas, kwargs={'forzar': True})
+    timer.daemon = True
+    _tabla_divisas['timer'] = timer
+    timer.start()
+
+def actualizar_tabla_divisas(forzar=False):
+    """Descargar latest/{base} completo y reprogramar la siguiente descarga"""
+    # Desde una petición no se espera a otra descarga en curso: se responde con lo que haya
+    if not _tabla_divisas_lock.acquire(blocking=forzar):
+        return
     try:
-        url = f'{EXCHANGE_BASE_URL}/{EXCHANGE_API_KEY}/pair/{de}/{a}/{monto}'
-        response = requests.get(url)
-        data = response.json()
+        # Tras un fallo, el reintento queda en manos del timer aunque la tabla siga vacía
+        if not forzar and time.monotonic() < _tabla_divisas['siguiente_refresco']:
+            return
         
-        if data['result'] != 'success':
-            return jsonify({'error': 'Error en conversión'}), 400
+        espera = DIVISAS_REFRESCO
+        try:
+            response = upstream_get(f'{EXCHANGE_BASE_URL}/{EXCHANGE_API_KEY}/latest/{DIVISAS_BASE}', proveedor='exchange')
+            data = response.json()
+            if data.get('result') == 'success':
+                _tabla_divisas.update({
+                    'base': data['base_code'],
+                    'tasas': data['conversion_rates'],
+                    'actualizado': datetime.fromtimestamp(data['time_last_update_unix'], timezone.utc).isoformat()
+                })
+            else:
+                print(f"Error obteniendo tasas de cambio: {data.get('error-type')}")
+                espera = DIVISAS_REINTENTO
+        except Exception as e:
+            print(f"Error obteniendo tasas de cambio: {e}")
+            espera = DIVISAS_REINTENTO
+        
+        _tabla_divisas['siguiente_refresco'] = time.monotonic() + espera
+        _programar_refresco_divisas(espera)
+    finally:
+        _tabla_divisas_lock.release()
+
+def obtener_tabla_divisas():
+    """Tabla de tasas vigente; solo la primera llamada espera a la descarga"""
+    if not _tabla_divisas['tasas'] and time.monotonic() >= _tabla_divisas['siguiente_refresco']:
+        actualizar_tabla_divisas()
+    return _tabla_divisas
+
+def tasa_cruzada(tabla, de, a):
+    """Tasa de 'de' a 'a' derivada a través de la moneda base; None si alguna no existe"""
+    tasas = tabla['tasas']
+    if de not in tasas or a not in tasas:
+        return None
+    return tasas[a] / tasas[de]
+
+def datos_conversion(monto, de, a):
+    tabla = obtener_tabla_divisas()
+    if not tabla['tasas']:
+        raise ErrorConsulta('Tasas de cambio no disponibles', 503)
+    
+    tasa = tasa_cruzada(tabla, de, a)
+    if tasa is None:
+        raise ErrorConsulta('Error en conversión', 400)
+    
+    return {
+        'monto_original': monto,
+        'moneda_origen': de,
+        'moneda_destino': a,
+        'monto_convertido': round(monto * tasa, 4),
+        'tasa_conversion': tasa,
+        'base': tabla['base'],
+        'ultima_actualizacion': tabla['actualizado']
+    }
+
+@app.route('/api/divisas/convertir')
+def convertir_divisas():
+    monto = request.args.get('monto', type=float)
+    de = request.args.get('de', 'USD').upper()
+    a = request.args.get('a', 'MXN').upper()
+    
+    if not monto or not math.isfinite(monto):
+        return jsonify({'error': 'Monto requerido'}), 400
+    
+    try:
+        return jsonify(datos_conversion(monto, de, a))
+    except Exception as e:
+        return error_upstream(e)
+
+@app.route('/api/divisas/convertir/lote', methods=['POST'])
+def convertir_divisas_lote():
+    """Convertir muchos montos en una sola petición usando la tabla local"""
+    data = request.get_json(silent=True) or {}
+    
+    # Formatos aceptados: lista de conversiones (también como cuerpo), o un monto contra varias monedas destino
+    if isinstance(data, list):
+        conversiones = data
+    elif not isinstance(data, dict):
+        return jsonify({'error': 'El cuerpo debe ser un objeto o una lista de conversiones'}), 400
+    elif isinstance(data.get('conversiones'), list):
+        conversiones = data['conversiones']
+    elif 'monto' in data and isinstance(data.get('a'), list):
+        conversiones = [{'monto': data['monto'], 'de': data.get('de', 'USD'), 'a': a} for a in data['a']]
+    else:
+        return jsonify({'error': 'Se requiere "conversiones" o "monto" con una lista de monedas en "a"'}), 400
+    
+    if len(conversiones) > DIVISAS_LOTE_MAX:
+        return jsonify({'error': f'Máximo {DIVISAS_LOTE_MAX} conversiones por petición'}), 400
+    
+    try:
+        tabla = obtener_tabla_divisas()
+        if not tabla['tasas']:
+            return jsonify({'error': 'Tasas de cambio no disponibles'}), 503
+        
+        # Cada par distinto se resuelve una sola vez contra la tabla
+        tasas_par = {}
+        resultados = []
+        for item in conversiones:
+            try:
+                if isinstance(item, dict):
+                    monto, de, a = item.get('monto'), item.get('de', 'USD'), item.get('a', 'MXN')
+                else:
+                    monto, de, a = item
+                monto = float(monto)
+                if not math.isfinite(monto):
+                    raise ValueError('Monto no finito')
+                de, a = str(de).upper(), str(a).upper()
+            except (TypeError, ValueError):
+                resultados.append({'error': 'Conversión inválida'})
+                continue
+            
+            par = (de, a)
+            if par not in tasas_par:
+                tasas_par[par] = tasa_cruzada(tabla, de, a)
+            tasa = tasas_par[par]
+            
+            if tasa is None:
+                resultados.append({'moneda_origen': de, 'moneda_destino': a, 'error': 'Moneda no soportada'})
+                continue
+            
+            resultados.append({
+                'monto_original': monto,
+                'moneda_origen': de,
+                'moneda_destino': a,
+                'monto_convertido': round(monto * tasa, 4),
+                'tasa_conversion': tasa
+            })
         
         return jsonify({
-            'monto_original': monto,
-            'moneda_origen': de,
-            'moneda_destino': a,
-            'monto_convertido': data['conversion_result'],
-            'tasa_conversion': data['conversion_rate']
+            'resultados': resultados,
+            'total': len(resultados),
+            'base': tabla['base'],
+            'ultima_actualizacion': tabla['actualizado']
         })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
 
 @app.route('/api/divisas/monedas')
 def listar_monedas():
@@ -555,17 +1545,44 @@ def listar_monedas():
     return jsonify(monedas)
 
 # ==================== GITHUB API ====================
+def ultima_pagina(respuesta):
+    """Número de la última página según la cabecera Link (rel="last"); 1 si no hay más"""
+    for enlace in parse_header_links(respuesta.headers.get('Link', '')):
+        if enlace.get('rel') == 'last':
+            pagina = dict(parse_qsl(urlsplit(enlace['url']).query)).get('page', '1')
+            return int(pagina) if pagina.isdigit() else 1
+    return 1
+
 @app.route('/api/github/usuario/<username>')
 def obtener_usuario_github(username):
     try:
-        user_response = requests.get(f'{GITHUB_API}/users/{username}')
+        # Perfil y primera página de repos en paralelo; las demás páginas en cuanto se conoce el total
+        url_repos = f'{GITHUB_API}/users/{username}/repos'
+        futuro_usuario = upstream_executor.submit(upstream_json, 'github', f'{GITHUB_API}/users/{username}')
+        futuro_repos = upstream_executor.submit(upstream_json, 'github', url_repos, params={'per_page': 100, 'page': 1})
+        
+        user_response = futuro_usuario.result()
         
         if user_response.status_code == 404:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
+        repos_response = futuro_repos.result()
+        if user_response.status_code != 200 or repos_response.status_code != 200:
+            return jsonify({'error': 'Error al obtener datos de GitHub'}), 500
+        
         usuario = user_response.json()
-        repos_response = requests.get(f'{GITHUB_API}/users/{username}/repos?per_page=100')
-        repos = repos_response.json()
+        repos = list(repos_response.json())
+        
+        paginas = min(ultima_pagina(repos_response), GITHUB_MAX_PAGINAS)
+        futuros_paginas = [
+            upstream_executor.submit(upstream_json, 'github', url_repos, params={'per_page': 100, 'page': pagina})
+            for pagina in range(2, paginas + 1)
+        ]
+        for futuro in futuros_paginas:
+            pagina_response = futuro.result()
+            if pagina_response.status_code != 200:
+                return jsonify({'error': 'Error al obtener repositorios'}), 500
+            repos.extend(pagina_response.json())
         
         total_stars = sum(repo['stargazers_count'] for repo in repos)
         total_forks = sum(repo['forks_count'] for repo in repos)
@@ -608,7 +1625,7 @@ def obtener_usuario_github(username):
         
         return jsonify(resultado)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
 
 @app.route('/api/github/buscar/repos')
 def buscar_repos_github():
@@ -618,7 +1635,8 @@ def buscar_repos_github():
         return jsonify({'error': 'Consulta requerida'}), 400
     
     try:
-        response = requests.get(
+        response = upstream_json(
+            'github',
             f'{GITHUB_API}/search/repositories',
             params={'q': query, 'sort': 'stars', 'order': 'desc', 'per_page': 15}
         )
@@ -637,89 +1655,101 @@ def buscar_repos_github():
         
         return jsonify(repos)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
 
 # ==================== LIBROS API ====================
+def descripcion_libro(info):
+    descripcion = info.get('description')
+    return (descripcion[:300] + '...') if descripcion else ''
+
+PROYECCION_LIBRO = Proyeccion({
+    'id': lambda item: item['id'],
+    'titulo': lambda item: item.get('volumeInfo', {}).get('title', 'Sin título'),
+    'autores': lambda item: item.get('volumeInfo', {}).get('authors', []),
+    'descripcion': lambda item: descripcion_libro(item.get('volumeInfo', {})),
+    'editorial': lambda item: item.get('volumeInfo', {}).get('publisher', ''),
+    'fecha_publicacion': lambda item: item.get('volumeInfo', {}).get('publishedDate', ''),
+    'paginas': lambda item: item.get('volumeInfo', {}).get('pageCount', 0),
+    'categorias': lambda item: item.get('volumeInfo', {}).get('categories', []),
+    'imagen': lambda item: item.get('volumeInfo', {}).get('imageLinks', {}).get('thumbnail', ''),
+    'preview_link': lambda item: item.get('volumeInfo', {}).get('previewLink', ''),
+    'rating': lambda item: item.get('volumeInfo', {}).get('averageRating', 0)
+})
+
 @app.route('/api/libros/buscar')
 def buscar_libros():
-    query = request.args.get('q', '')
-    max_results = request.args.get('max', 20, type=int)
-    
-    if not query:
-        return jsonify({'error': 'Consulta requerida'}), 400
-    
     try:
-        response = requests.get(
-            GOOGLE_BOOKS_API,
-            params={'q': query, 'maxResults': min(max_results, 40), 'printType': 'books', 'langRestrict': 'es'}
-        )
-        data = response.json()
-        
-        if 'items' not in data:
-            return jsonify([])
-        
-        libros = []
-        for item in data['items']:
-            info = item.get('volumeInfo', {})
-            venta = item.get('saleInfo', {})
-            
-            libro = {
-                'id': item['id'],
-                'titulo': info.get('title', 'Sin título'),
-                'autores': info.get('authors', []),
-                'descripcion': (info.get('description', '')[:300] + '...') if info.get('description') else '',
-                'editorial': info.get('publisher', ''),
-                'fecha_publicacion': info.get('publishedDate', ''),
-                'paginas': info.get('pageCount', 0),
-                'categorias': info.get('categories', []),
-                'imagen': info.get('imageLinks', {}).get('thumbnail', ''),
-                'preview_link': info.get('previewLink', ''),
-                'rating': info.get('averageRating', 0)
-            }
-            
-            libros.append(libro)
-        
-        return jsonify(libros)
+        consulta, plan = busqueda_libros(request.args)
+        return jsonify(resultado_libros(upstream_json(**consulta), plan))
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
+
+def busqueda_libros(args):
+    """Validar los parámetros de /api/libros/buscar; devuelve (consulta a Google Books, plan)"""
+    query = args.get('q', '')
+    if not query:
+        raise ErrorConsulta('Consulta requerida', 400)
+    
+    plan = plan_pedido(PROYECCION_LIBRO, args)
+    consulta = {
+        'proveedor': 'books',
+        'url': GOOGLE_BOOKS_API,
+        'params': {'q': query, 'maxResults': min(args.get('max', 20, type=int), 40), 'printType': 'books', 'langRestrict': 'es'}
+    }
+    return consulta, plan
+
+def resultado_libros(response, plan):
+    data = response.json()
+    if 'items' not in data:
+        return []
+    return PROYECCION_LIBRO.aplicar(plan, data['items'])
 
 # ==================== REDDIT API ====================
-@app.route('/api/reddit/posts')
-def obtener_posts_reddit():
-    subreddit = request.args.get('subreddit', 'python')
-    filtro = request.args.get('filtro', 'hot')
-    limit = request.args.get('limit', 10, type=int)
+def consulta_reddit(subreddit, filtro, limit):
+    return {
+        'proveedor': 'reddit',
+        'url': f'https://www.reddit.com/r/{subreddit}/{filtro}.json',
+        'headers': {'User-Agent': 'Mozilla/5.0 (FlaskApp/1.0)'},
+        'params': {'limit': limit}
+    }
+
+def datos_reddit(subreddit, filtro, limit):
+    return resultado_reddit(subreddit, upstream_json(**consulta_reddit(subreddit, filtro, limit)))
+
+def resultado_reddit(subreddit, response):
+    if response.status_code == 404:
+        raise ErrorConsulta('Subreddit no encontrado', 404)
     
-    url = f'https://www.reddit.com/r/{subreddit}/{filtro}.json'
-    headers = {'User-Agent': 'Mozilla/5.0 (FlaskApp/1.0)'}
+    data = response.json()
     
-    try:
-        response = requests.get(url, headers=headers, params={'limit': limit})
-        
-        if response.status_code == 404:
-            return jsonify({'error': 'Subreddit no encontrado'}), 404
-        
-        data = response.json()
-        
-        posts = []
-        for post in data['data']['children']:
-            post_data = post['data']
-            fecha = datetime.fromtimestamp(post_data['created_utc'])
-            
-            posts.append({
-                'titulo': post_data['title'],
-                'autor': post_data['author'],
-                'puntos': post_data['score'],
-                'comentarios': post_data['num_comments'],
-                'url': f"https://reddit.com{post_data['permalink']}",
-                'fecha': fecha.strftime('%Y-%m-%d %H:%M'),
-                'thumbnail': post_data.get('thumbnail') if post_data.get('thumbnail') not in ['self', 'default', ''] else None,
-                'selftext': (post_data.get('selftext', '')[:200] + '...') if post_data.get('selftext') else ''
-            })
+    posts = []
+    for post in data['data']['children']:
+        post_data = post['data']
+        fecha = datetime.fromtimestamp(post_data['created_utc'])
         
-        return jsonify({'subreddit': subreddit, 'posts': posts})
+        posts.append({
+            'titulo': post_data['title'],
+            'autor': post_data['author'],
+            'puntos': post_data['score'],
+            'comentarios': post_data['num_comments'],
+            'url': f"https://reddit.com{post_data['permalink']}",
+            'fecha': fecha.strftime('%Y-%m-%d %H:%M'),
+            'thumbnail': post_data.get('thumbnail') if post_data.get('thumbnail') not in ['self', 'default', ''] else None,
+            'selftext': (post_data.get('selftext', '')[:200] + '...') if post_data.get('selftext') else ''
+        })
+    
+    return {'subreddit': subreddit, 'posts': posts}
+
+@app.route('/api/reddit/posts')
+def obtener_posts_reddit():
+    try:
+        return jsonify(datos_reddit(*parametros_reddit(request.args)))
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
+
+def parametros_reddit(args):
+    """(subreddit, filtro, limit) de /api/reddit/posts"""
+    return args.get('subreddit', 'python'), args.get('filtro', 'hot'), args.get('limit', 10, type=int)
 
 @app.route('/api/reddit/subreddits/populares')
 def subreddits_populares():
@@ -736,68 +1766,479 @@ def subreddits_populares():
     return jsonify(subreddits)
 
 # ==================== LUGARES API ====================
-@app.route('/api/lugares')
-def buscar_lugares():
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
-    tipo = request.args.get('tipo', 'restaurant')
-    radio = request.args.get('radio', 1000, type=int)
-    
-    tipos_osm = {
-        'restaurant': 'amenity=restaurant',
-        'hospital': 'amenity=hospital',
-        'cafe': 'amenity=cafe',
-        'farmacia': 'amenity=pharmacy',
-        'tienda': 'shop=supermarket',
-        'gasolinera': 'amenity=fuel',
-        'banco': 'amenity=bank',
-        'hotel': 'tourism=hotel'
+TIPOS_OSM = {
+    'restaurant': 'amenity=restaurant',
+    'hospital': 'amenity=hospital',
+    'cafe': 'amenity=cafe',
+    'farmacia': 'amenity=pharmacy',
+    'tienda': 'shop=supermarket',
+    'gasolinera': 'amenity=fuel',
+    'banco': 'amenity=bank',
+    'hotel': 'tourism=hotel'
+}
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash(lat, lon, precision):
+    """Codificar una coordenada como geohash de la precisión indicada"""
+    lat_rango, lon_rango = [-90.0, 90.0], [-180.0, 180.0]
+    resultado, bits, n_bits, es_lon = [], 0, 0, True
+    while len(resultado) < precision:
+        rango, valor = (lon_rango, lon) if es_lon else (lat_rango, lat)
+        medio = (rango[0] + rango[1]) / 2
+        if valor >= medio:
+            bits = bits * 2 + 1
+            rango[0] = medio
+        else:
+            bits = bits * 2
+            rango[1] = medio
+        es_lon = not es_lon
+        n_bits += 1
+        if n_bits == 5:
+            resultado.append(_GEOHASH_BASE32[bits])
+            bits, n_bits = 0, 0
+    return ''.join(resultado)
+
+def geohash_bbox(hash_):
+    """Caja (sur, oeste, norte, este) de un geohash"""
+    lat_rango, lon_rango = [-90.0, 90.0], [-180.0, 180.0]
+    es_lon = True
+    for caracter in hash_:
+        valor = _GEOHASH_BASE32.index(caracter)
+        for desplazamiento in range(4, -1, -1):
+            rango = lon_rango if es_lon else lat_rango
+            medio = (rango[0] + rango[1]) / 2
+            if (valor >> desplazamiento) & 1:
+                rango[0] = medio
+            else:
+                rango[1] = medio
+            es_lon = not es_lon
+    return lat_rango[0], lon_rango[0], lat_rango[1], lon_rango[1]
+
+def tamano_geohash(precision):
+    """Alto y ancho en grados de una celda geohash"""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+def caja_radio(lat, lon, radio):
+    """Caja (sur, oeste, norte, este) que contiene el círculo (lat, lon, radio en metros)"""
+    dlat_radio = radio / 111320
+    dlon_radio = radio / (111320 * max(math.cos(math.radians(lat)), 0.01))
+    return (max(lat - dlat_radio, -90), max(lon - dlon_radio, -180),
+            min(lat + dlat_radio, 90), min(lon + dlon_radio, 180))
+
+def contar_tiles(caja, precision):
+    """Número de celdas que recorre tiles_cubriendo, calculado sin generar ningún geohash"""
+    sur, oeste, norte, este = caja
+    alto, ancho = tamano_geohash(precision)
+    filas = math.ceil((norte + 90) / alto) - math.floor((sur + 90) / alto)
+    columnas = math.ceil((este + 180) / ancho) - math.floor((oeste + 180) / ancho)
+    return max(filas, 1) * max(columnas, 1)
+
+def tiles_cubriendo(caja, precision):
+    """Geohashes que cubren la caja (sur, oeste, norte, este)"""
+    sur, oeste, norte, este = caja
+    alto, ancho = tamano_geohash(precision)
+    
+    tiles = set()
+    fila = math.floor((sur + 90) / alto)
+    while fila * alto - 90 < norte:
+        columna = math.floor((oeste + 180) / ancho)
+        while columna * ancho - 180 < este:
+            centro_lat = min(fila * alto - 90 + alto / 2, 90)
+            centro_lon = min(columna * ancho - 180 + ancho / 2, 180)
+            tiles.add(geohash(centro_lat, centro_lon, precision))
+            columna += 1
+        fila += 1
+    return tiles
+
+def distancia_metros(lat1, lon1, lat2, lon2):
+    """Distancia haversine en metros"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def lugar_desde_elemento(elemento):
+    """Convertir un elemento OSM (node o way con center) al formato de la API; None si no tiene coordenadas"""
+    if 'center' in elemento:
+        coords = elemento['center']
+    elif 'lat' in elemento:
+        coords = {'lat': elemento['lat'], 'lon': elemento['lon']}
+    else:
+        return None
+    
+    tags = elemento.get('tags', {})
+    return {
+        'nombre': tags.get('name', 'Sin nombre'),
+        'direccion': tags.get('addr:street', '') + ' ' + tags.get('addr:housenumber', ''),
+        'lat': coords['lat'],
+        'lon': coords['lon'],
+        'tipo': tags.get('amenity') or tags.get('shop') or tags.get('tourism', ''),
+        'telefono': tags.get('phone', ''),
+        'horario': tags.get('opening_hours', '')
     }
+
+def consulta_overpass(query, tiles):
+    """Una sola consulta Overpass QL que cubre todas las tiles"""
+    sentencias = []
+    for tile in sorted(tiles):
+        bbox = ','.join(str(coord) for coord in geohash_bbox(tile))
+        sentencias.append(f'node[{query}]({bbox});')
+        sentencias.append(f'way[{query}]({bbox});')
+    return '[out:json][timeout:25];\n(\n' + '\n'.join(sentencias) + '\n);\nout center;'
+
+def _descargar_tiles_overpass(query, tiles):
+    """Una sola consulta Overpass para todas las tiles faltantes; reparte los lugares por tile y los cachea"""
+    response = upstream_post(OVERPASS_URL, data={'data': consulta_overpass(query, tiles)}, timeout=30, proveedor='overpass')
+    response.raise_for_status()
+    return repartir_tiles_overpass(query, tiles, response.json())
+
+def repartir_tiles_overpass(query, tiles, data):
+    """Repartir los lugares por tile y cachearlos; una respuesta con remark no se cachea"""
+    # Overpass informa timeouts y falta de memoria con 200, "remark" y elements vacío o parcial
+    if data.get('remark'):
+        circuito_de('overpass').registrar(False)
+        raise requests.HTTPError(f"Overpass no completó la consulta: {data['remark']}")
     
-    query = tipos_osm.get(tipo, 'amenity=restaurant')
+    precision = len(next(iter(tiles)))
+    por_tile = {tile: [] for tile in tiles}
+    for elemento in data.get('elements', []):
+        lugar = lugar_desde_elemento(elemento)
+        if lugar is None:
+            continue
+        tile = geohash(lugar['lat'], lugar['lon'], precision)
+        if tile in por_tile:
+            por_tile[tile].append(lugar)
     
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    overpass_query = f"""
-    [out:json];
-    (
-      node[{query}](around:{radio},{lat},{lon});
-      way[{query}](around:{radio},{lat},{lon});
-    );
-    out center;
-    """
+    ttl, stale = politica_cache('overpass')
+    for tile, lugares in por_tile.items():
+        cache_upstream.guardar(f'overpass:{query}:{tile}', 'overpass', lugares, ttl, stale)
+    return por_tile
+
+def descargar_tiles_overpass(query, tiles):
+    clave = f'overpass:{query}:' + ','.join(sorted(tiles))
+    por_tile, compartido = upstream_vuelos.hacer(clave, lambda: _descargar_tiles_overpass(query, tiles))
+    if compartido:
+        cache_upstream.contar('overpass', 'coalescidas')
+    return por_tile
+
+def tiles_en_cache(query, lat, lon, radio):
+    """Lugares de las tiles cacheadas que cubren el radio; devuelve (lugares, faltantes, viejas)"""
+    # Precisión más fina cuyo número de tiles no supere el máximo; solo se generan las de esa precisión
+    caja = caja_radio(lat, lon, radio)
+    precision = next((p for p in (7, 6, 5) if contar_tiles(caja, p) <= LUGARES_MAX_TILES), 4)
+    tiles = tiles_cubriendo(caja, precision)
     
-    try:
-        response = requests.get(overpass_url, params={'data': overpass_query}, timeout=30)
-        data = response.json()
+    lugares, faltantes, viejas = [], set(), set()
+    for tile in tiles:
+        valor, estado = cache_upstream.obtener(f'overpass:{query}:{tile}', 'overpass')
+        if estado is None:
+            faltantes.add(tile)
+            continue
+        if estado == 'stale':
+            viejas.add(tile)
+        lugares.extend(valor)
+    return lugares, faltantes, viejas
+
+def lugares_por_tiles(query, lat, lon, radio):
+    """Reunir los lugares de las tiles que cubren el radio, descargando solo las que faltan"""
+    lugares, faltantes, viejas = tiles_en_cache(query, lat, lon, radio)
+    if faltantes:
+        for tile_lugares in descargar_tiles_overpass(query, faltantes).values():
+            lugares.extend(tile_lugares)
+    if viejas:
+        # Las tiles caducadas se sirven igual y se refrescan en segundo plano
+        upstream_executor.submit(descargar_tiles_overpass, query, viejas)
+    return lugares
+
+# ==================== LUGARES OFFLINE (índice OSM local) ====================
+class IndiceLugares:
+    """Índice espacial en rejilla: coordenadas en arrays contiguos ordenados por celda"""
+
+    def __init__(self, lugares, celda=LUGARES_INDICE_CELDA):
+        self.celda = celda
+        orden = sorted(range(len(lugares)), key=lambda i: self._celda(lugares[i]['lat'], lugares[i]['lon']))
+        self.lats = array('d', (lugares[i]['lat'] for i in orden))
+        self.lons = array('d', (lugares[i]['lon'] for i in orden))
+        self.lugares = [lugares[i] for i in orden]
         
-        lugares = []
-        for elemento in data['elements'][:20]:
-            if 'center' in elemento:
-                coords = elemento['center']
-            elif 'lat' in elemento:
-                coords = {'lat': elemento['lat'], 'lon': elemento['lon']}
-            else:
-                continue
-            
-            tags = elemento.get('tags', {})
-            lugares.append({
-                'nombre': tags.get('name', 'Sin nombre'),
-                'direccion': tags.get('addr:street', '') + ' ' + tags.get('addr:housenumber', ''),
-                'lat': coords['lat'],
-                'lon': coords['lon'],
-                'tipo': tags.get('amenity') or tags.get('shop') or tags.get('tourism', ''),
-                'telefono': tags.get('phone', ''),
-                'horario': tags.get('opening_hours', '')
-            })
+        # celda -> (inicio, fin) dentro de los arrays
+        self.rangos = {}
+        for posicion in range(len(self.lugares)):
+            clave = self._celda(self.lats[posicion], self.lons[posicion])
+            inicio, _ = self.rangos.get(clave, (posicion, posicion))
+            self.rangos[clave] = (inicio, posicion + 1)
+
+    def _celda(self, lat, lon):
+        return math.floor(lat / self.celda), math.floor(lon / self.celda)
+
+    def __len__(self):
+        return len(self.lugares)
+
+    def cercanos(self, lat, lon, radio, limite):
+        """Los 'limite' lugares más cercanos dentro del radio (metros), ordenados por distancia"""
+        dlat = radio / 111320
+        dlon = radio / (111320 * max(math.cos(math.radians(lat)), 0.01))
+        fila_min, columna_min = self._celda(lat - dlat, lon - dlon)
+        fila_max, columna_max = self._celda(lat + dlat, lon + dlon)
         
-        return jsonify(lugares)
+        candidatos = []
+        for fila in range(fila_min, fila_max + 1):
+            for columna in range(columna_min, columna_max + 1):
+                rango = self.rangos.get((fila, columna))
+                if rango is None:
+                    continue
+                for posicion in range(*rango):
+                    distancia = distancia_metros(lat, lon, self.lats[posicion], self.lons[posicion])
+                    if distancia <= radio:
+                        candidatos.append((distancia, posicion))
+        
+        return [
+            dict(self.lugares[posicion], distancia=round(distancia))
+            for distancia, posicion in heapq.nsmallest(limite, candidatos)
+        ]
+
+_indices_lugares = {'mtime': None, 'indices': None}
+_indices_lugares_lock = threading.Lock()
+
+def obtener_indices_lugares():
+    """Índices por tipo OSM cargados desde LUGARES_INDICE; se recargan si el archivo cambia"""
+    try:
+        mtime = os.path.getmtime(LUGARES_INDICE)
+    except OSError:
+        return None
+    
+    if _indices_lugares['mtime'] != mtime:
+        with _indices_lugares_lock:
+            if _indices_lugares['mtime'] != mtime:
+                with open(LUGARES_INDICE, encoding='utf-8') as archivo:
+                    datos = json.load(archivo)
+                _indices_lugares['indices'] = {query: IndiceLugares(lugares) for query, lugares in datos.items()}
+                _indices_lugares['mtime'] = mtime
+    return _indices_lugares['indices']
+
+def _tipos_de_tags(tags):
+    """Consultas de TIPOS_OSM (clave=valor) que cumple un conjunto de tags"""
+    consultas = []
+    for query in TIPOS_OSM.values():
+        clave, valor = query.split('=', 1)
+        if tags.get(clave) == valor:
+            consultas.append(query)
+    return consultas
+
+def _elementos_osm(ruta):
+    """Recorrer los node/way/relation de un .osm soltándolos de la raíz para que la memoria no crezca"""
+    contexto = ET.iterparse(ruta, events=('start', 'end'))
+    _, raiz = next(contexto)
+    for evento, elem in contexto:
+        if evento == 'end' and elem.tag in ('node', 'way', 'relation'):
+            yield elem
+            # elem.clear() solo lo vacía; sigue colgado de la raíz hasta que se limpia ésta
+            raiz.clear()
+
+def _leer_elementos_osm_xml(ruta):
+    """Leer nodes y ways etiquetados de un extracto .osm en dos pasadas para no guardar todos los nodos"""
+    ways = []
+    nodos_necesarios = set()
+    for elem in _elementos_osm(ruta):
+        if elem.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            if _tipos_de_tags(tags):
+                refs = [nd.get('ref') for nd in elem.iter('nd')]
+                ways.append({'tags': tags, 'refs': refs})
+                nodos_necesarios.update(refs)
+    
+    coordenadas = {}
+    for elem in _elementos_osm(ruta):
+        if elem.tag == 'node':
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            lat, lon = float(elem.get('lat')), float(elem.get('lon'))
+            if elem.get('id') in nodos_necesarios:
+                coordenadas[elem.get('id')] = (lat, lon)
+            if _tipos_de_tags(tags):
+                yield {'lat': lat, 'lon': lon, 'tags': tags}
+    
+    for way in ways:
+        puntos = [coordenadas[ref] for ref in way['refs'] if ref in coordenadas]
+        if puntos:
+            centro = {
+                'lat': sum(p[0] for p in puntos) / len(puntos),
+                'lon': sum(p[1] for p in puntos) / len(puntos)
+            }
+            yield {'center': centro, 'tags': way['tags']}
+
+def construir_indice_lugares(ruta_origen, ruta_destino):
+    """Construir el archivo de índice a partir de un extracto OSM (.osm XML) o una exportación JSON de Overpass"""
+    if ruta_origen.endswith('.json'):
+        with open(ruta_origen, encoding='utf-8') as archivo:
+            elementos = json.load(archivo).get('elements', [])
+    else:
+        elementos = _leer_elementos_osm_xml(ruta_origen)
+    
+    por_tipo = {query: [] for query in TIPOS_OSM.values()}
+    for elemento in elementos:
+        lugar = lugar_desde_elemento(elemento)
+        if lugar is None:
+            continue
+        for query in _tipos_de_tags(elemento.get('tags', {})):
+            por_tipo[query].append(lugar)
+    
+    temporal = ruta_destino + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as archivo:
+        json.dump(por_tipo, archivo, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temporal, ruta_destino)
+    return {query: len(lugares) for query, lugares in por_tipo.items()}
+
+@app.cli.command('importar-lugares')
+@click.argument('archivo')
+def importar_lugares_comando(archivo):
+    """Importar un extracto OSM al índice local de lugares (LUGARES_INDICE)"""
+    totales = construir_indice_lugares(archivo, LUGARES_INDICE)
+    for query, total in totales.items():
+        print(f"  {query}: {total}")
+    print(f"✅ Índice de lugares guardado en {LUGARES_INDICE} ({sum(totales.values())} lugares)")
+
+@app.route('/api/lugares')
+def buscar_lugares():
+    try:
+        query, lat, lon, radio, limite = busqueda_lugares(request.args)
+        locales = lugares_de_indice(query, lat, lon, radio, limite)
+        if locales is not None:
+            return jsonify(locales)
+        return jsonify(lugares_cercanos(lugares_por_tiles(query, lat, lon, radio), lat, lon, radio, limite))
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_upstream(e)
+
+def busqueda_lugares(args):
+    """Validar los parámetros de /api/lugares; devuelve (query OSM, lat, lon, radio, limite)"""
+    lat = args.get('lat', type=float)
+    lon = args.get('lon', type=float)
+    if lat is None or lon is None:
+        raise ErrorConsulta('Latitud y longitud requeridas', 400)
+    
+    radio = max(1, min(args.get('radio', 1000, type=int), LUGARES_RADIO_MAX))
+    query = TIPOS_OSM.get(args.get('tipo', 'restaurant'), 'amenity=restaurant')
+    return query, lat, lon, radio, args.get('limite', 20, type=int)
+
+def lugares_de_indice(query, lat, lon, radio, limite):
+    """Con LUGARES_FUENTE=local, lugares del índice importado; None si no se usa o no existe"""
+    indices = obtener_indices_lugares() if LUGARES_FUENTE == 'local' else None
+    if indices is None:
+        return None
+    indice = indices.get(query)
+    return indice.cercanos(lat, lon, radio, limite) if indice else []
+
+def lugares_cercanos(lugares, lat, lon, radio, limite):
+    """Lugares dentro del radio, ordenados por distancia"""
+    cercanos = []
+    for lugar in lugares:
+        distancia = distancia_metros(lat, lon, lugar['lat'], lugar['lon'])
+        if distancia <= radio:
+            cercanos.append(dict(lugar, distancia=round(distancia)))
+    
+    cercanos.sort(key=lambda l: l['distancia'])
+    return cercanos[:limite]
 
 # ==================== PRODUCTOS API (SQLite) ====================
+def nueva_conexion_db():
+    """Abrir una conexión configurada una sola vez: WAL, caché, mmap y busy timeout"""
+    conn = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_BYTES}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+    return conn
+
+def crear_agregados_productos(cursor):
+    """Tabla de agregados por categoría mantenida por triggers; se reconstruye al arrancar"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS productos_stats (
+            categoria TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            suma_precios REAL NOT NULL DEFAULT 0,
+            stock_total INTEGER NOT NULL DEFAULT 0,
+            valor_inventario REAL NOT NULL DEFAULT 0,
+            stock_bajo INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # Suma (signo=+1) o resta (signo=-1) la fila NEW/OLD en su categoría
+    def ajuste(fila, signo):
+        return f'''
+            INSERT OR IGNORE INTO productos_stats (categoria) VALUES (IFNULL({fila}.categoria, ''));
+            UPDATE productos_stats SET
+                total = total + {signo},
+                suma_precios = suma_precios + {signo} * {fila}.precio,
+                stock_total = stock_total + {signo} * IFNULL({fila}.stock, 0),
+                valor_inventario = valor_inventario + {signo} * {fila}.precio * IFNULL({fila}.stock, 0),
+                stock_bajo = stock_bajo + {signo} * (IFNULL({fila}.stock, 0) < {STOCK_BAJO_UMBRAL})
+            WHERE categoria = IFNULL({fila}.categoria, '');
+        '''
+    limpiar = "DELETE FROM productos_stats WHERE total <= 0;"
+    
+    # Se recrean en cada arranque por si cambió STOCK_BAJO_UMBRAL
+    for nombre in ('productos_stats_insert', 'productos_stats_update', 'productos_stats_delete'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {nombre}')
+    cursor.execute(f'CREATE TRIGGER productos_stats_insert AFTER INSERT ON productos BEGIN {ajuste("NEW", 1)} END')
+    cursor.execute(f'CREATE TRIGGER productos_stats_update AFTER UPDATE ON productos BEGIN {ajuste("OLD", -1)} {ajuste("NEW", 1)} {limpiar} END')
+    cursor.execute(f'CREATE TRIGGER productos_stats_delete AFTER DELETE ON productos BEGIN {ajuste("OLD", -1)} {limpiar} END')
+    
+    cursor.execute('DELETE FROM productos_stats')
+    cursor.execute(f'''
+        INSERT INTO productos_stats (categoria, total, suma_precios, stock_total, valor_inventario, stock_bajo)
+        SELECT IFNULL(categoria, ''), COUNT(*), SUM(precio), SUM(IFNULL(stock, 0)),
+               SUM(precio * IFNULL(stock, 0)), SUM(IFNULL(stock, 0) < {STOCK_BAJO_UMBRAL})
+        FROM productos GROUP BY IFNULL(categoria, '')
+    ''')
+
+def crear_busqueda_productos(cursor):
+    """Índice FTS5 sobre nombre, descripción y categoría sincronizado con productos por triggers"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'productos_fts'")
+    existia = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS productos_fts USING fts5(
+            nombre, descripcion, categoria,
+            content='productos', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    
+    nueva = "INSERT INTO productos_fts (rowid, nombre, descripcion, categoria) VALUES (NEW.id, NEW.nombre, NEW.descripcion, NEW.categoria);"
+    vieja = "INSERT INTO productos_fts (productos_fts, rowid, nombre, descripcion, categoria) VALUES ('delete', OLD.id, OLD.nombre, OLD.descripcion, OLD.categoria);"
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS productos_fts_insert AFTER INSERT ON productos BEGIN {nueva} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS productos_fts_update AFTER UPDATE ON productos BEGIN {vieja} {nueva} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS productos_fts_delete AFTER DELETE ON productos BEGIN {vieja} END')
+    
+    # Una base de datos anterior al índice se indexa una sola vez
+    if not existia:
+        cursor.execute("INSERT INTO productos_fts (productos_fts) VALUES ('rebuild')")
+
+def crear_version_productos(cursor):
+    """Versión de los datos de productos para los ETag; se incrementa en cada cambio y en cada arranque"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS productos_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO productos_version (id, version) VALUES (1, 0)')
+    
+    incremento = 'UPDATE productos_version SET version = version + 1;'
+    for evento in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'CREATE TRIGGER IF NOT EXISTS productos_version_{evento.lower()} AFTER {evento} ON productos BEGIN {incremento} END')
+    
+    # La configuración (p. ej. STOCK_BAJO_UMBRAL) puede haber cambiado entre arranques
+    cursor.execute(incremento)
+
 def init_db():
     """Inicializar base de datos"""
-    conn = sqlite3.connect(DATABASE)
+    conn = nueva_conexion_db()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS productos (
@@ -811,6 +2252,32 @@ def init_db():
         )
     ''')
     
+    # Índices para filtros y paginación por cursor (columna de orden + id)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_productos_categoria ON productos (categoria, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_productos_categoria_precio ON productos (categoria, precio, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_productos_precio ON productos (precio, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_productos_nombre ON productos (nombre, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_productos_stock ON productos (stock, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_productos_fecha ON productos (fecha_creacion, id)')
+    
+    # Registro durable del chat (solo se añaden filas)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mensajes_chat (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            avatar TEXT,
+            timestamp TEXT NOT NULL
+        )
+    ''')
+    
+    crear_agregados_productos(cursor)
+    crear_version_productos(cursor)
+    try:
+        crear_busqueda_productos(cursor)
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  ADVERTENCIA: búsqueda de productos no disponible (FTS5): {e}")
+    
     cursor.execute('SELECT COUNT(*) FROM productos')
     if cursor.fetchone()[0] == 0:
         productos_ejemplo = [
@@ -828,21 +2295,161 @@ def init_db():
     conn.commit()
     conn.close()
 
+# Pool pequeño de conexiones reutilizables entre peticiones
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def tomar_conexion_db():
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return nueva_conexion_db()
+
+def devolver_conexion_db(conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _db_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
+
+@contextmanager
+def conexion_db():
+    """Conexión del pool fuera del ciclo de una petición (p. ej. dentro de un stream SSE)"""
+    conn = tomar_conexion_db()
+    try:
+        yield conn
+    finally:
+        devolver_conexion_db(conn)
+
 def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Conexión del pool para la petición actual; se devuelve al pool en el teardown"""
+    if 'db' not in g:
+        g.db = tomar_conexion_db()
+    return g.db
+
+@app.teardown_appcontext
+def liberar_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        devolver_conexion_db(conn)
+
+def cerrar_pool_db():
+    while True:
+        try:
+            _db_pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+atexit.register(cerrar_pool_db)
+
+def codificar_cursor(valor, id):
+    return base64.urlsafe_b64encode(json.dumps([valor, id]).encode()).decode().rstrip('=')
+
+def decodificar_cursor(cursor):
+    """Cursor opaco -> (valor de la columna de orden, id); ValueError si no es válido"""
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        valor, id = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+        return valor, int(id)
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Cursor inválido')
+
+def consulta_productos(args):
+    """Construir el SELECT filtrado, ordenado y paginado por cursor a partir de los query params"""
+    orden = args.get('orden', 'id')
+    direccion = args.get('dir', 'asc').lower()
+    limite = args.get('limite', PRODUCTOS_LIMITE_DEFECTO, type=int)
+    if orden not in COLUMNAS_ORDEN_PRODUCTOS or direccion not in ('asc', 'desc'):
+        raise ValueError('Orden no válido')
+    limite = max(1, min(limite, PRODUCTOS_LIMITE_MAX))
+    
+    condiciones, parametros = [], []
+    if args.get('categoria'):
+        condiciones.append('categoria = ?')
+        parametros.append(args['categoria'])
+    if args.get('precio_min') is not None:
+        condiciones.append('precio >= ?')
+        parametros.append(args.get('precio_min', type=float))
+    if args.get('precio_max') is not None:
+        condiciones.append('precio <= ?')
+        parametros.append(args.get('precio_max', type=float))
+    if args.get('en_stock') is not None:
+        condiciones.append('stock > 0' if args['en_stock'].lower() in ('1', 'true', 'si') else 'stock <= 0')
+    if None in parametros:
+        raise ValueError('Filtro de precio no válido')
+    
+    # Keyset: continuar después de la última fila vista en vez de usar OFFSET
+    comparador = '>' if direccion == 'asc' else '<'
+    if args.get('cursor'):
+        valor, ultimo_id = decodificar_cursor(args['cursor'])
+        if orden == 'id':
+            condiciones.append(f'id {comparador} ?')
+            parametros.append(ultimo_id)
+        else:
+            condiciones.append(f'({orden}, id) {comparador} (?, ?)')
+            parametros.extend([valor, ultimo_id])
+    
+    sql = 'SELECT * FROM productos'
+    if condiciones:
+        sql += ' WHERE ' + ' AND '.join(condiciones)
+    direccion = direccion.upper()
+    sql += f' ORDER BY {orden} {direccion}' if orden == 'id' else f' ORDER BY {orden} {direccion}, id {direccion}'
+    sql += ' LIMIT ?'
+    parametros.append(limite + 1)
+    return sql, parametros, orden, limite
+
+def version_productos(conn):
+    """Contador que los triggers incrementan con cada cambio en productos"""
+    return conn.execute('SELECT version FROM productos_version').fetchone()[0]
+
+def validado_por_version(vista):
+    """ETag de los GET de productos a partir de la versión de los datos: el 304 no ejecuta la consulta"""
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        if request.method != 'GET':
+            return vista(*args, **kwargs)
+        try:
+            base = f'productos.v{version_productos(get_db())}'
+        except sqlite3.Error:
+            return vista(*args, **kwargs)
+        if etag_coincide(base):
+            return no_modificado(base)
+        
+        respuesta = app.make_response(vista(*args, **kwargs))
+        if respuesta.status_code == 200:
+            respuesta.set_etag(base)
+        return respuesta
+    return envoltura
 
 @app.route('/api/productos', methods=['GET', 'POST'])
+@validado_por_version
 def productos_api():
     if request.method == 'GET':
+        try:
+            sql, parametros, orden, limite = consulta_productos(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         try:
             conn = get_db()
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM productos')
+            cursor.execute(sql, parametros)
             productos = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            return jsonify(productos)
+            
+            # Se pide una fila de más para saber si hay página siguiente
+            siguiente = None
+            if len(productos) > limite:
+                productos = productos[:limite]
+                ultimo = productos[-1]
+                siguiente = codificar_cursor(ultimo[orden], ultimo['id'])
+            
+            respuesta = jsonify(productos)
+            if siguiente:
+                args = request.args.to_dict()
+                args['cursor'] = siguiente
+                respuesta.headers['X-Siguiente-Cursor'] = siguiente
+                respuesta.headers['Link'] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+            return respuesta
         except Exception as e:
             return jsonify({'error': str(e)}), 500
     
@@ -866,12 +2473,242 @@ def productos_api():
             ))
             conn.commit()
             producto_id = cursor.lastrowid
-            conn.close()
             return jsonify({'id': producto_id, 'mensaje': 'Producto creado exitosamente'}), 201
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
+COLUMNAS_EXPORTACION = ('id', 'nombre', 'descripcion', 'precio', 'stock', 'categoria', 'fecha_creacion')
+
+def validar_fila_producto(fila):
+    """Tupla lista para INSERT a partir de un dict importado; ValueError con el motivo si no es válida"""
+    if not isinstance(fila, dict):
+        raise ValueError('La fila debe ser un objeto')
+    nombre = fila.get('nombre')
+    if not isinstance(nombre, str) or not nombre.strip():
+        raise ValueError('Nombre requerido')
+    try:
+        precio = float(fila.get('precio'))
+    except (TypeError, ValueError):
+        raise ValueError('Precio inválido')
+    if not math.isfinite(precio):
+        raise ValueError('Precio inválido')
+    try:
+        stock = int(fila.get('stock') or 0)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('Stock inválido')
+    if not -2**63 <= stock < 2**63:
+        raise ValueError('Stock inválido')
+    descripcion, categoria = fila.get('descripcion') or '', fila.get('categoria') or 'General'
+    if not isinstance(descripcion, str) or not isinstance(categoria, str):
+        raise ValueError('Descripción y categoría deben ser texto')
+    return (nombre.strip(), descripcion, precio, stock, categoria)
+
+def filas_importacion(formato, flujo):
+    """Generar (línea, dict o excepción) leyendo el cuerpo de la petición sin cargarlo entero"""
+    texto = io.TextIOWrapper(flujo, encoding='utf-8', newline='')
+    if formato == 'csv':
+        lector = csv.DictReader(texto)
+        for fila in lector:
+            yield lector.line_num, fila
+        return
+    
+    for numero, linea in enumerate(texto, start=1):
+        if not linea.strip():
+            continue
+        try:
+            yield numero, json.loads(linea)
+        except ValueError as e:
+            yield numero, ValueError(f'JSON inválido: {e}')
+
+@app.route('/api/productos/importar', methods=['POST'])
+def importar_productos():
+    """Importar NDJSON o CSV en streaming, insertando por lotes y reportando errores por fila"""
+    formato = request.args.get('formato') or ('csv' if 'csv' in (request.content_type or '') else 'ndjson')
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Formato no soportado (csv o ndjson)'}), 400
+    
+    sql = '''
+        INSERT INTO productos (nombre, descripcion, precio, stock, categoria)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+    insertados, total_errores = 0, 0
+    errores, lote = [], []
+    
+    def registrar_error(linea, motivo):
+        nonlocal total_errores
+        total_errores += 1
+        if len(errores) < IMPORTACION_MAX_ERRORES:
+            errores.append({'linea': linea, 'error': motivo})
+    
+    def insertar_lote(conn, lote):
+        """Insertar un lote en una transacción; si SQLite rechaza alguna fila, se reintenta fila a fila"""
+        try:
+            conn.executemany(sql, [valores for _, valores in lote])
+            conn.commit()
+            return len(lote)
+        except (sqlite3.Error, OverflowError):
+            conn.rollback()
+        
+        correctas = 0
+        for linea, valores in lote:
+            try:
+                conn.execute(sql, valores)
+                correctas += 1
+            except (sqlite3.Error, OverflowError) as e:
+                registrar_error(linea, str(e))
+        conn.commit()
+        return correctas
+    
+    try:
+        conn = get_db()
+        for linea, fila in filas_importacion(formato, request.stream):
+            try:
+                if isinstance(fila, Exception):
+                    raise fila
+                lote.append((linea, validar_fila_producto(fila)))
+            except ValueError as e:
+                registrar_error(linea, str(e))
+                continue
+            
+            # Cada lote va en su propia transacción
+            if len(lote) >= IMPORTACION_LOTE:
+                insertados += insertar_lote(conn, lote)
+                lote = []
+        
+        if lote:
+            insertados += insertar_lote(conn, lote)
+    except Exception as e:
+        return jsonify({'error': str(e), 'insertados': insertados}), 500
+    
+    return jsonify({
+        'insertados': insertados,
+        'total_errores': total_errores,
+        'errores': errores
+    }), 201 if insertados else 200
+
+@app.route('/api/productos/exportar')
+def exportar_productos():
+    """Exportar el catálogo como NDJSON o CSV generando las filas desde el cursor"""
+    formato = request.args.get('formato', 'ndjson')
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Formato no soportado (csv o ndjson)'}), 400
+    
+    def generar():
+        conn = get_db()
+        cursor = conn.execute(f'SELECT {", ".join(COLUMNAS_EXPORTACION)} FROM productos ORDER BY id')
+        if formato == 'csv':
+            buffer = io.StringIO()
+            escritor = csv.writer(buffer)
+            escritor.writerow(COLUMNAS_EXPORTACION)
+            yield buffer.getvalue()
+        
+        while True:
+            filas = cursor.fetchmany(EXPORTACION_LOTE)
+            if not filas:
+                break
+            if formato == 'csv':
+                buffer.seek(0)
+                buffer.truncate()
+                escritor.writerows(tuple(fila) for fila in filas)
+                yield buffer.getvalue()
+            else:
+                yield ''.join(json.dumps(dict(fila), ensure_ascii=False) + '\n' for fila in filas)
+    
+    mimetype = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+    respuesta = Response(stream_with_context(generar()), mimetype=mimetype)
+    respuesta.headers['Content-Disposition'] = f'attachment; filename=productos.{formato}'
+    return respuesta
+
+def consulta_fts(texto):
+    """Convertir el texto del usuario en una consulta FTS5 de prefijos: "lap"* "hp"*"""
+    terminos = [t.replace('"', '""') for t in texto.split() if t.strip('"')]
+    return ' '.join(f'"{t}"*' for t in terminos)
+
+@app.route('/api/productos/buscar')
+@validado_por_version
+def buscar_productos():
+    query = request.args.get('q', '')
+    pagina = max(request.args.get('pagina', 1, type=int), 1)
+    limite = max(1, min(request.args.get('limite', 20, type=int), PRODUCTOS_LIMITE_MAX))
+    
+    consulta = consulta_fts(query)
+    if not consulta:
+        return jsonify({'error': 'Consulta requerida'}), 400
+    
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        # bm25 con más peso al nombre que a la categoría y la descripción
+        cursor.execute('''
+            SELECT p.*, bm25(productos_fts, 10.0, 2.0, 5.0) AS relevancia
+            FROM productos_fts
+            JOIN productos p ON p.id = productos_fts.rowid
+            WHERE productos_fts MATCH ?
+            ORDER BY relevancia
+            LIMIT ? OFFSET ?
+        ''', (consulta, limite + 1, (pagina - 1) * limite))
+        productos = [dict(row) for row in cursor.fetchall()]
+        
+        return jsonify({
+            'productos': productos[:limite],
+            'pagina': pagina,
+            'hay_mas': len(productos) > limite
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def datos_stats_productos(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM productos_stats ORDER BY total DESC, categoria')
+    por_categoria = [dict(row) for row in cursor.fetchall()]
+    
+    total = sum(c['total'] for c in por_categoria)
+    generales = {
+        'total': total,
+        'precio_promedio': sum(c['suma_precios'] for c in por_categoria) / total if total else 0,
+        'stock_total': sum(c['stock_total'] for c in por_categoria),
+        'valor_inventario': round(sum(c['valor_inventario'] for c in por_categoria), 2),
+        'stock_bajo': sum(c['stock_bajo'] for c in por_categoria),
+        'umbral_stock_bajo': STOCK_BAJO_UMBRAL
+    }
+    
+    return {
+        'generales': generales,
+        'por_categoria': [
+            {
+                'categoria': c['categoria'],
+                'total': c['total'],
+                'precio_promedio': c['suma_precios'] / c['total'],
+                'stock_total': c['stock_total'],
+                'valor_inventario': round(c['valor_inventario'], 2),
+                'stock_bajo': c['stock_bajo']
+            }
+            for c in por_categoria
+        ]
+    }
+
+@app.route('/api/productos/stats')
+@validado_por_version
+def productos_stats():
+    """Estadísticas del inventario leídas de los agregados (O(categorías), sin recorrer productos)"""
+    try:
+        return jsonify(datos_stats_productos(get_db()))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/categorias')
+@validado_por_version
+def categorias_productos():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT categoria FROM productos_stats WHERE categoria != '' ORDER BY categoria")
+        return jsonify([row['categoria'] for row in cursor.fetchall()])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/productos/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@validado_por_version
 def producto_especifico(id):
     if request.method == 'GET':
         try:
@@ -879,7 +2716,6 @@ def producto_especifico(id):
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM productos WHERE id = ?', (id,))
             producto = cursor.fetchone()
-            conn.close()
             
             if producto is None:
                 return jsonify({'error': 'Producto no encontrado'}), 404
@@ -895,7 +2731,6 @@ def producto_especifico(id):
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM productos WHERE id = ?', (id,))
             if cursor.fetchone() is None:
-                conn.close()
                 return jsonify({'error': 'Producto no encontrado'}), 404
             
             cursor.execute('''
@@ -911,7 +2746,6 @@ def producto_especifico(id):
                 id
             ))
             conn.commit()
-            conn.close()
             return jsonify({'mensaje': 'Producto actualizado exitosamente'})
         except Exception as e:
             return jsonify({'error': str(e)}), 500
@@ -923,15 +2757,993 @@ def producto_especifico(id):
             cursor.execute('DELETE FROM productos WHERE id = ?', (id,))
             
             if cursor.rowcount == 0:
-                conn.close()
                 return jsonify({'error': 'Producto no encontrado'}), 404
             
             conn.commit()
-            conn.close()
             return jsonify({'mensaje': 'Producto eliminado exitosamente'})
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
+# ==================== CHAT (SSE con long-poll de respaldo) ====================
+CHAT_SSE_MAX = int(os.getenv('CHAT_SSE_MAX', 50))
+CHAT_SSE_DURACION = int(os.getenv('CHAT_SSE_DURACION', 300))
+CHAT_SSE_LATIDO = int(os.getenv('CHAT_SSE_LATIDO', 15))
+CHAT_LONGPOLL_MAX = int(os.getenv('CHAT_LONGPOLL_MAX', 25))
+CHAT_PRESENCIA_TTL = int(os.getenv('CHAT_PRESENCIA_TTL', 15))
+CHAT_BUFFER = int(os.getenv('CHAT_BUFFER', 200))
+CHAT_HISTORIAL_MAX = 100
+CHAT_TEXTO_MAX = 500
+
+class CanalChat:
+    """Despierta a los clientes en espera (SSE o long-poll) cuando cambia algo en el chat"""
+    
+    def __init__(self, max_suscriptores):
+        self.max_suscriptores = max_suscriptores
+        self.suscriptores = 0
+        self.version = 0
+        self.condicion = threading.Condition()
+    
+    def notificar(self):
+        with self.condicion:
+            self.version += 1
+            self.condicion.notify_all()
+    
+    def esperar(self, version, timeout):
+        """Bloquear hasta que la versión cambie o venza el timeout; devuelve la versión actual"""
+        with self.condicion:
+            self.condicion.wait_for(lambda: self.version != version, timeout)
+            return self.version
+    
+    def suscribir(self):
+        with self.condicion:
+            if self.suscriptores >= self.max_suscriptores:
+                return False
+            self.suscriptores += 1
+            return True
+    
+    def desuscribir(self):
+        with self.condicion:
+            self.suscriptores -= 1
+
+canal_chat = CanalChat(CHAT_SSE_MAX)
+
+class BufferMensajes:
+    """Últimos mensajes en memoria (ring buffer) delante del registro en SQLite"""
+    
+    def __init__(self, capacidad):
+        self.mensajes = deque(maxlen=capacidad)
+        # Todo mensaje con id mayor que este está en el buffer
+        self.cubre_desde = 0
+        self.cargado = False
+        self.lock = threading.Lock()
+    
+    def cargar(self):
+        """Rellenar el buffer con la cola del registro la primera vez que se usa"""
+        with self.lock:
+            if self.cargado:
+                return
+            with conexion_db() as conn:
+                filas = conn.execute(
+                    'SELECT * FROM mensajes_chat ORDER BY id DESC LIMIT ?', (self.mensajes.maxlen + 1,)
+                ).fetchall()
+            filas = [dict(fila) for fila in reversed(filas)]
+            if len(filas) > self.mensajes.maxlen:
+                self.cubre_desde = filas.pop(0)['id']
+            self.mensajes.extend(filas)
+            self.cargado = True
+    
+    def agregar(self, mensaje):
+        with self.lock:
+            if len(self.mensajes) == self.mensajes.maxlen:
+                self.cubre_desde = self.mensajes[0]['id']
+            self.mensajes.append(mensaje)
+    
+    def desde(self, ultimo_id):
+        """Mensajes posteriores a ultimo_id, o None si parte de ellos ya salió del buffer"""
+        self.cargar()
+        with self.lock:
+            if ultimo_id and ultimo_id < self.cubre_desde:
+                return None
+            nuevos = []
+            for mensaje in reversed(self.mensajes):
+                if mensaje['id'] <= ultimo_id:
+                    break
+                nuevos.append(mensaje)
+        nuevos.reverse()
+        return nuevos
+
+buffer_chat = BufferMensajes(CHAT_BUFFER)
+_mensajes_lock = threading.Lock()
+
+def publicar_mensaje(conn, usuario, texto, avatar):
+    """Guardar el mensaje en el registro, añadirlo al buffer y avisar a los suscriptores"""
+    buffer_chat.cargar()
+    timestamp = datetime.now(timezone.utc).isoformat()
+    # Un solo escritor a la vez: los ids entran al buffer en orden
+    with _mensajes_lock:
+        cursor = conn.execute(
+            'INSERT INTO mensajes_chat (usuario, texto, avatar, timestamp) VALUES (?, ?, ?, ?)',
+            (usuario, texto, avatar, timestamp)
+        )
+        conn.commit()
+        mensaje = {
+            'id': cursor.lastrowid,
+            'usuario': usuario,
+            'texto': texto,
+            'avatar': avatar,
+            'timestamp': timestamp
+        }
+        buffer_chat.agregar(mensaje)
+    canal_chat.notificar()
+    return mensaje
+
+def mensajes_desde(ultimo_id):
+    """Delta de mensajes desde ultimo_id; sin cursor devuelve solo los recientes"""
+    nuevos = buffer_chat.desde(ultimo_id)
+    if nuevos is not None:
+        return nuevos
+    
+    # Cliente muy atrasado: se lee del registro en tramos del tamaño del buffer
+    with conexion_db() as conn:
+        filas = conn.execute(
+            'SELECT * FROM mensajes_chat WHERE id > ? ORDER BY id LIMIT ?', (ultimo_id, CHAT_BUFFER)
+        ).fetchall()
+    return [dict(fila) for fila in filas]
+
+class RegistroPresencia:
+    """Último latido por usuario en orden de llegada; los expirados se retiran por el frente"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # Con TTL fijo, el orden de inserción es también el orden de expiración
+        self.vistos = OrderedDict()
+        self.snapshot = None
+        self.lock = threading.Lock()
+    
+    def _expirar(self, ahora):
+        """Retirar usuarios caducados desde el más antiguo; True si cambió la lista"""
+        limite = ahora - self.ttl
+        cambio = False
+        while self.vistos:
+            usuario, visto = next(iter(self.vistos.items()))
+            if visto >= limite:
+                break
+            self.vistos.popitem(last=False)
+            cambio = True
+        if cambio:
+            self.snapshot = None
+        return cambio
+    
+    def latido(self, usuario):
+        """Upsert O(1); True si entró o salió alguien"""
+        ahora = time.monotonic()
+        with self.lock:
+            cambio = self._expirar(ahora)
+            if usuario not in self.vistos:
+                self.snapshot = None
+                cambio = True
+            self.vistos[usuario] = ahora
+            self.vistos.move_to_end(usuario)
+        return cambio
+    
+    def activos(self):
+        """Lista ordenada de usuarios conectados y si cambió respecto a la anterior"""
+        with self.lock:
+            cambio = self._expirar(time.monotonic())
+            if self.snapshot is None:
+                self.snapshot = sorted(self.vistos)
+            return self.snapshot, cambio
+
+presencia_chat = RegistroPresencia(CHAT_PRESENCIA_TTL)
+
+def latido_usuario(usuario):
+    """Registrar un latido de presencia; avisa al canal si cambió la lista de conectados"""
+    if presencia_chat.latido(usuario):
+        canal_chat.notificar()
+
+def usuarios_online():
+    """Usuarios con latido reciente (la lista se reutiliza mientras nadie entre ni salga)"""
+    activos, cambio = presencia_chat.activos()
+    if cambio:
+        canal_chat.notificar()
+    return activos
+
+def evento_sse(tipo, datos, id_evento=None):
+    """Serializar un evento en formato text/event-stream"""
+    linea_id = f'id: {id_evento}\n' if id_evento is not None else ''
+    return f'{linea_id}event: {tipo}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n'
+
+def ultimo_id_evento():
+    """Id desde el que reanudar: cabecera Last-Event-ID (reconexión) o ?since="""
+    valor = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        return int(valor) if valor is not None else None
+    except ValueError:
+        return None
+
+@app.route('/api/chat/eventos')
+def eventos_chat():
+    """Canal SSE: mensajes nuevos y cambios de presencia, reanudable con Last-Event-ID"""
+    if not canal_chat.suscribir():
+        return jsonify({'error': 'Demasiadas conexiones en vivo, usa long-poll'}), 503, {'Retry-After': '5'}
+    
+    ultimo_id = ultimo_id_evento() or 0
+    
+    def generar():
+        nonlocal ultimo_id
+        fin = time.monotonic() + CHAT_SSE_DURACION
+        presencia = None
+        version = canal_chat.version
+        # El navegador reconecta solo (con Last-Event-ID) cuando se cierra el stream
+        yield 'retry: 3000\n\n'
+        while True:
+            # Un cliente muy atrasado recibe los tramos del registro seguidos; solo se espera con el delta al día
+            while True:
+                nuevos = mensajes_desde(ultimo_id)
+                for mensaje in nuevos:
+                    ultimo_id = mensaje['id']
+                    yield evento_sse('mensaje', mensaje, mensaje['id'])
+                if len(nuevos) < CHAT_BUFFER:
+                    break
+            
+            activos = usuarios_online()
+            if activos is not presencia:
+                presencia = activos
+                yield evento_sse('presencia', activos)
+            
+            restante = fin - time.monotonic()
+            if restante <= 0:
+                return
+            nueva = canal_chat.esperar(version, min(CHAT_SSE_LATIDO, restante))
+            if nueva == version:
+                # Comentario SSE para mantener viva la conexión y detectar clientes caídos
+                yield ': ping\n\n'
+            version = nueva
+    
+    respuesta = Response(generar(), mimetype='text/event-stream')
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    respuesta.call_on_close(canal_chat.desuscribir)
+    return respuesta
+
+@app.route('/api/mensajes', methods=['GET', 'POST'])
+def mensajes():
+    """Listar mensajes (con ?since= y ?esperar= actúa como long-poll) o publicar uno nuevo"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        usuario = str(data.get('usuario') or '').strip()
+        texto = str(data.get('texto') or '').strip()
+        if not usuario or not texto:
+            return jsonify({'error': 'Usuario y texto requeridos'}), 400
+        if len(texto) > CHAT_TEXTO_MAX:
+            return jsonify({'error': f'Máximo {CHAT_TEXTO_MAX} caracteres'}), 400
+        
+        latido_usuario(usuario)
+        try:
+            mensaje = publicar_mensaje(get_db(), usuario, texto, data.get('avatar') or '👤')
+        except sqlite3.Error as e:
+            return jsonify({'error': str(e)}), 500
+        return jsonify(mensaje), 201
+    
+    ultimo_id = ultimo_id_evento() or 0
+    espera = min(request.args.get('esperar', 0, type=float), CHAT_LONGPOLL_MAX)
+    fin = time.monotonic() + espera
+    
+    version = canal_chat.version
+    nuevos = mensajes_desde(ultimo_id)
+    while not nuevos and (restante := fin - time.monotonic()) > 0:
+        version = canal_chat.esperar(version, restante)
+        nuevos = mensajes_desde(ultimo_id)
+    return jsonify(nuevos)
+
+@app.route('/api/mensajes/historial')
+def historial_mensajes():
+    """Historial paginado hacia atrás: ?antes=<id>&limite="""
+    antes = request.args.get('antes', type=int)
+    limite = max(1, min(request.args.get('limite', 50, type=int), CHAT_HISTORIAL_MAX))
+    
+    try:
+        conn = get_db()
+        if antes:
+            filas = conn.execute(
+                'SELECT * FROM mensajes_chat WHERE id < ? ORDER BY id DESC LIMIT ?', (antes, limite + 1)
+            ).fetchall()
+        else:
+            filas = conn.execute(
+                'SELECT * FROM mensajes_chat ORDER BY id DESC LIMIT ?', (limite + 1,)
+            ).fetchall()
+    except sqlite3.Error as e:
+        return jsonify({'error': str(e)}), 500
+    
+    hay_mas = len(filas) > limite
+    mensajes = [dict(fila) for fila in reversed(filas[:limite])]
+    return jsonify({
+        'mensajes': mensajes,
+        'hay_mas': hay_mas,
+        'antes': mensajes[0]['id'] if hay_mas else None
+    })
+
+@app.route('/api/usuarios/online', methods=['GET', 'POST'])
+def usuarios_chat():
+    """Latido de presencia (POST) o lista de usuarios conectados (GET)"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        usuario = str(data.get('usuario') or '').strip()
+        if not usuario:
+            return jsonify({'error': 'Usuario requerido'}), 400
+        latido_usuario(usuario)
+        return jsonify({'usuario': usuario, 'ttl': CHAT_PRESENCIA_TTL})
+    
+    return jsonify(usuarios_online())
+
+# ==================== DASHBOARD ====================
+DASHBOARD_DEADLINE = float(os.getenv('DASHBOARD_DEADLINE', 4))
+DASHBOARD_WORKERS = int(os.getenv('DASHBOARD_WORKERS', 4))
+
+class SeccionDashboard:
+    """Sección del dashboard con sus propios hilos: una sección lenta no deja sin hueco a las demás"""
+    
+    def __init__(self, nombre, funcion, defecto, local=None):
+        self.funcion = funcion
+        self.defecto = defecto
+        # Las secciones locales (sin red) se resuelven en el propio hilo de la petición
+        self.local = local or (lambda: False)
+        self.huecos = threading.BoundedSemaphore(DASHBOARD_WORKERS)
+        self.executor = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix=f'dashboard-{nombre}')
+    
+    def params(self, args):
+        """Parámetros por defecto sobrescritos por los de la petición, con el mismo tipo"""
+        return {clave: args.get(clave, valor, type=type(valor)) for clave, valor in self.defecto.items()}
+    
+    def lanzar(self, params):
+        """Futuro con el resultado, o None si la sección ya tiene todos sus hilos ocupados"""
+        if not self.huecos.acquire(blocking=False):
+            return None
+        futuro = self.executor.submit(resultado_seccion, self.funcion, params)
+        futuro.add_done_callback(lambda _: self.huecos.release())
+        return futuro
+
+def resultado_seccion(funcion, params):
+    """Ejecutar una sección y resumir el resultado con su estado"""
+    try:
+        return {'estado': 'ok', 'datos': funcion(**params)}
+    except ErrorConsulta as e:
+        return {'estado': 'error', 'codigo': e.codigo, 'error': str(e)}
+    except UpstreamNoDisponible as e:
+        return {'estado': 'error', 'codigo': 503, 'error': str(e)}
+    except Exception as e:
+        return {'estado': 'error', 'error': str(e)}
+
+SECCIONES_DASHBOARD = {
+    'clima': SeccionDashboard('clima', datos_clima, {'ip': ''}),
+    'peliculas': SeccionDashboard('peliculas', datos_peliculas_populares, {'page': 1}),
+    'reddit': SeccionDashboard('reddit', datos_reddit, {'subreddit': 'python', 'filtro': 'hot', 'limit': 5}),
+    'divisas': SeccionDashboard('divisas', datos_conversion, {'monto': 1.0, 'de': 'USD', 'a': 'MXN'},
+                                local=lambda: bool(_tabla_divisas['tasas'])),
+    'productos': SeccionDashboard('productos', lambda: datos_stats_productos(get_db()), {}, local=lambda: True),
+}
+
+@app.route('/api/dashboard')
+def dashboard():
+    """Todas las secciones del dashboard en paralelo bajo un único plazo, con estado por sección"""
+    pedidas = request.args.get('secciones')
+    nombres = [n.strip() for n in pedidas.split(',')] if pedidas else list(SECCIONES_DASHBOARD)
+    desconocidas = [n for n in nombres if n not in SECCIONES_DASHBOARD]
+    if desconocidas:
+        return jsonify({'error': f"Secciones desconocidas: {', '.join(desconocidas)}"}), 400
+    
+    limite = time.monotonic() + DASHBOARD_DEADLINE
+    secciones, futuros, locales = {}, {}, []
+    for nombre in nombres:
+        seccion = SECCIONES_DASHBOARD[nombre]
+        params = seccion.params(request.args)
+        if 'ip' in params:
+            params['ip'] = ip_geolocalizable(ip_cliente())
+        if seccion.local():
+            locales.append((nombre, seccion, params))
+            continue
+        futuro = seccion.lanzar(params)
+        if futuro is None:
+            secciones[nombre] = {'estado': 'saturado'}
+        else:
+            futuros[nombre] = futuro
+    
+    # Las locales se resuelven mientras las remotas esperan a la red
+    for nombre, seccion, params in locales:
+        secciones[nombre] = resultado_seccion(seccion.funcion, params)
+    
+    for nombre, futuro in futuros.items():
+        try:
+            secciones[nombre] = futuro.result(timeout=max(0, limite - time.monotonic()))
+        except FuturesTimeout:
+            secciones[nombre] = {'estado': 'timeout'}
+    
+    secciones = {nombre: secciones[nombre] for nombre in nombres}
+    completas = sum(1 for seccion in secciones.values() if seccion['estado'] == 'ok')
+    return jsonify({'secciones': secciones, 'completas': completas, 'total': len(secciones)})
+
+# ==================== DIAGNÓSTICO ====================
+@app.route('/api/cache/stats')
+def estadisticas_cache():
+    """Contadores de la cache de APIs externas para ajustar TTLs y tamaño"""
+    stats = cache_upstream.estadisticas()
+    stats['politicas'] = {
+        proveedor: dict(zip(('ttl', 'stale'), politica_cache(proveedor)), max_entradas=limite_cache(proveedor))
+        for proveedor in POLITICAS_CACHE
+    }
+    return jsonify(stats)
+
+@app.route('/api/upstream/cuotas')
+def estado_cuotas():
+    """Presupuesto restante y bloqueos conocidos por proveedor"""
+    return jsonify(cuotas_upstream.estado())
+
+@app.route('/api/upstream/circuitos')
+def estado_circuitos():
+    """Estado del circuit breaker y del bulkhead de cada proveedor"""
+    with _circuitos_lock:
+        circuitos = list(circuitos_upstream.values())
+    return jsonify({circuito.proveedor: circuito.resumen() for circuito in circuitos})
+
+# ==================== MODO ASÍNCRONO (ASGI) ====================
+# `uvicorn main:asgi_app` atiende las rutas que solo esperan a APIs externas con corrutinas:
+# miles de esperas simultáneas cuestan tareas de asyncio en vez de hilos. Comparten cache,
+# cuotas, circuit breaker y bulkhead con el modo con hilos; el resto de rutas va a la app Flask
+# en un pool de hilos propio, así un stream SSE o un long-poll no bloquea a las demás.
+ASYNC_CONEXIONES = int(os.getenv('ASYNC_CONEXIONES', 1000))
+ASYNC_SONDEO_BULKHEAD = 0.01
+# Hilos para las rutas de Flask bajo ASGI: cada stream SSE o long-poll del chat ocupa uno mientras dura
+ASGI_HILOS_FLASK = int(os.getenv('ASGI_HILOS_FLASK', 256))
+
+_cliente_async = None
+_tareas_async = set()
+
+def cliente_async():
+    """Sesión aiohttp compartida; se crea dentro del bucle de eventos que la usa"""
+    global _cliente_async
+    if _cliente_async is None:
+        _cliente_async = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_CONEXIONES))
+    return _cliente_async
+
+async def cerrar_cliente_async():
+    global _cliente_async
+    if _cliente_async is not None:
+        await _cliente_async.close()
+        _cliente_async = None
+
+class RespuestaAsync:
+    """Respuesta de aiohttp ya leída, con la interfaz de requests que usa el resto del código"""
+
+    def __init__(self, status_code, headers, contenido, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.contenido = contenido
+        self.url = url
+
+    def json(self):
+        return json.loads(self.contenido)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error: {self.url}')
+
+async def peticion_async(method, url, read_timeout, params=None, **kwargs):
+    # aiohttp solo acepta str/int/float en la query; se serializa como requests (None se omite)
+    if params:
+        params = {clave: str(valor) for clave, valor in params.items() if valor is not None}
+    timeout = aiohttp.ClientTimeout(total=None, connect=UPSTREAM_CONNECT_TIMEOUT, sock_read=read_timeout)
+    async with cliente_async().request(method, url, params=params, timeout=timeout, **kwargs) as response:
+        contenido = await response.read()
+        return RespuestaAsync(response.status, CaseInsensitiveDict(response.headers), contenido, str(response.url))
+
+def tarea_de_fondo(corrutina):
+    """Lanzar una corrutina sin esperarla, conservando la referencia hasta que termine"""
+    tarea = asyncio.ensure_future(corrutina)
+    _tareas_async.add(tarea)
+    tarea.add_done_callback(_tareas_async.discard)
+    return tarea
+
+async def reservar_cuota_async(proveedor, prioridad):
+    """Como CuotasUpstream.reservar, pero cediendo el bucle mientras espera el reinicio"""
+    while True:
+        espera = cuotas_upstream.intentar_reservar(proveedor, prioridad)
+        if espera <= 0:
+            return
+        if prioridad == 'fondo' or espera > CUOTA_ESPERA_MAX:
+            raise CuotaAgotada(proveedor, espera)
+        await asyncio.sleep(espera)
+
+async def ocupar_bulkhead(circuito):
+    """Como bulkhead.acquire(timeout=BULKHEAD_ESPERA), pero cediendo el bucle mientras espera"""
+    limite = time.monotonic() + BULKHEAD_ESPERA
+    while not circuito.bulkhead.acquire(blocking=False):
+        if time.monotonic() >= limite:
+            circuito.contar('saturadas')
+            raise ProveedorSaturado(circuito.proveedor, 1)
+        await asyncio.sleep(ASYNC_SONDEO_BULKHEAD)
+
+async def upstream_request_async(method, url, timeout=None, proveedor=None, prioridad='interactiva', **kwargs):
+    """upstream_request con corrutinas: mismo circuito, cuota y bulkhead sin bloquear el bucle"""
+    read_timeout = timeout if timeout is not None else UPSTREAM_TIMEOUT
+    if proveedor is None:
+        return await peticion_async(method, url, read_timeout, **kwargs)
+    
+    circuito = circuito_de(proveedor)
+    circuito.permitir()
+    try:
+        await reservar_cuota_async(proveedor, prioridad)
+        await ocupar_bulkhead(circuito)
+    except BaseException:
+        # También si el cliente se desconecta (CancelledError) mientras espera
+        circuito.cancelar()
+        raise
+    
+    inicio = time.monotonic()
+    try:
+        response = await peticion_async(method, url, read_timeout, **kwargs)
+    except asyncio.CancelledError:
+        circuito.cancelar()
+        raise
+    except Exception:
+        circuito.registrar(False)
+        raise
+    finally:
+        circuito.bulkhead.release()
+    
+    circuito.registrar(response.status_code < 500 and time.monotonic() - inicio <= circuito.latencia_lenta)
+    cuotas_upstream.actualizar(proveedor, response)
+    return response
+
+class SingleFlightAsync:
+    """SingleFlight para corrutinas: la descarga corre en su propia tarea y los demás la esperan"""
+
+    def __init__(self):
+        self._en_vuelo = {}
+
+    async def hacer(self, clave, funcion):
+        """Devuelve (resultado, compartido); cancelar a quien espera no cancela la descarga compartida"""
+        tarea = self._en_vuelo.get(clave)
+        compartido = tarea is not None
+        if not compartido:
+            tarea = tarea_de_fondo(funcion())
+            self._en_vuelo[clave] = tarea
+            tarea.add_done_callback(lambda _: self._en_vuelo.pop(clave, None))
+        return await asyncio.shield(tarea), compartido
+
+upstream_vuelos_async = SingleFlightAsync()
+
+async def _descargar_json_async(proveedor, clave, url, params, headers, timeout, anterior=None, prioridad='interactiva'):
+    async def descargar():
+        headers_peticion, etag = cabeceras_revalidacion(headers, anterior)
+        response = await upstream_request_async(
+            'GET', url, params=params, headers=headers_peticion, timeout=timeout,
+            proveedor=proveedor, prioridad=prioridad
+        )
+        return guardar_respuesta_json(proveedor, clave, response, anterior, etag)
+    
+    resultado, compartido = await upstream_vuelos_async.hacer(clave, descargar)
+    if compartido:
+        cache_upstream.contar(proveedor, 'coalescidas')
+    return resultado
+
+def _refrescar_async(proveedor, clave, url, params, headers, timeout, anterior):
+    with _refrescos_lock:
+        if clave in _refrescos_en_curso:
+            return
+        _refrescos_en_curso.add(clave)
+    
+    async def tarea():
+        try:
+            await _descargar_json_async(proveedor, clave, url, params, headers, timeout, anterior, prioridad='fondo')
+            cache_upstream.contar(proveedor, 'refrescos')
+        except Exception as e:
+            print(f"Error refrescando cache de {proveedor}: {e}")
+        finally:
+            with _refrescos_lock:
+                _refrescos_en_curso.discard(clave)
+    
+    tarea_de_fondo(tarea())
+
+async def upstream_json_async(proveedor, url, params=None, headers=None, timeout=None):
+    """upstream_json con corrutinas: la misma cache, stale-while-revalidate y copia degradada"""
+    clave = clave_cache('GET', url, params)
+    valor, estado = cache_upstream.obtener(clave, proveedor)
+    if estado == 'fresco':
+        return valor
+    if estado == 'stale':
+        _refrescar_async(proveedor, clave, url, params, headers, timeout, valor)
+        return valor
+    try:
+        return await _descargar_json_async(proveedor, clave, url, params, headers, timeout, valor)
+    except UpstreamNoDisponible:
+        if valor is not None:
+            cache_upstream.contar(proveedor, 'servidos_degradado')
+            return valor
+        raise
+
+async def descargar_tiles_overpass_async(query, tiles):
+    async def descargar():
+        response = await upstream_request_async(
+            'POST', OVERPASS_URL, data={'data': consulta_overpass(query, tiles)}, timeout=30, proveedor='overpass'
+        )
+        response.raise_for_status()
+        return repartir_tiles_overpass(query, tiles, response.json())
+    
+    clave = f'overpass:{query}:' + ','.join(sorted(tiles))
+    por_tile, compartido = await upstream_vuelos_async.hacer(clave, descargar)
+    if compartido:
+        cache_upstream.contar('overpass', 'coalescidas')
+    return por_tile
+
+async def refrescar_tiles_async(query, tiles):
+    try:
+        await descargar_tiles_overpass_async(query, tiles)
+    except Exception as e:
+        print(f"Error refrescando tiles de overpass: {e}")
+
+# Rutas servidas con corrutinas: ruta -> vista(args, cabeceras, cliente) que devuelve datos JSON
+RUTAS_ASYNC = {}
+
+def ruta_async(ruta):
+    def registrar(vista):
+        RUTAS_ASYNC[ruta] = vista
+        return vista
+    return registrar
+
+@ruta_async('/api/peliculas/populares')
+async def peliculas_populares_async(args, cabeceras, cliente):
+    response = await upstream_json_async(**consulta_peliculas_populares(args.get('page', 1, type=int)))
+    return resultado_peliculas_populares(response)
+
+@ruta_async('/api/peliculas/buscar')
+async def buscar_peliculas_async(args, cabeceras, cliente):
+    consulta, plan = busqueda_peliculas(args)
+    return resultado_busqueda_peliculas(await upstream_json_async(**consulta), plan)
+
+@ruta_async('/api/spotify/buscar')
+async def buscar_spotify_async(args, cabeceras, cliente):
+    params, tipo, plan = busqueda_spotify(args)
+    # El token casi siempre está vigente (se refresca con un temporizador); si no, se pide en un hilo
+    token = await asyncio.to_thread(get_spotify_token)
+    response = await upstream_json_async(**consulta_spotify(params, token))
+    return resultado_spotify(response, tipo, plan)
+
+@ruta_async('/api/libros/buscar')
+async def buscar_libros_async(args, cabeceras, cliente):
+    consulta, plan = busqueda_libros(args)
+    return resultado_libros(await upstream_json_async(**consulta), plan)
+
+@ruta_async('/api/reddit/posts')
+async def posts_reddit_async(args, cabeceras, cliente):
+    subreddit, filtro, limit = parametros_reddit(args)
+    return resultado_reddit(subreddit, await upstream_json_async(**consulta_reddit(subreddit, filtro, limit)))
+
+@ruta_async('/api/clima')
+async def clima_async(args, cabeceras, cliente):
+    ip = ip_geolocalizable(ip_real(cliente, cabeceras.get('X-Forwarded-For')))
+    ubicacion = (await upstream_json_async(**consulta_ubicacion(ip))).json()
+    clima = (await upstream_json_async(**consulta_clima(ubicacion))).json()
+    return resultado_clima(ubicacion, clima)
+
+async def lugares_por_tiles_async(query, lat, lon, radio):
+    lugares, faltantes, viejas = tiles_en_cache(query, lat, lon, radio)
+    if faltantes:
+        for tile_lugares in (await descargar_tiles_overpass_async(query, faltantes)).values():
+            lugares.extend(tile_lugares)
+    if viejas:
+        tarea_de_fondo(refrescar_tiles_async(query, viejas))
+    return lugares
+
+@ruta_async('/api/lugares')
+async def buscar_lugares_async(args, cabeceras, cliente):
+    query, lat, lon, radio, limite = busqueda_lugares(args)
+    if LUGARES_FUENTE == 'local':
+        # La primera llamada lee el índice de disco; se hace en un hilo para no frenar el bucle
+        locales = await asyncio.to_thread(lugares_de_indice, query, lat, lon, radio, limite)
+        if locales is not None:
+            return locales
+    return lugares_cercanos(await lugares_por_tiles_async(query, lat, lon, radio), lat, lon, radio, limite)
+
+def representacion_json(datos, codigo, cabeceras, metodo, extra):
+    """Cuerpo y cabeceras de una respuesta JSON con el mismo ETag y compresión que comprimir_y_validar"""
+    cuerpo = app.json.response(datos).get_data()
+    salida = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding', **extra}
+    base = None
+    if codigo == 200:
+        base = hashlib.blake2b(cuerpo, digest_size=16).hexdigest()
+        if etag_coincide_con(cabeceras.get('If-None-Match'), base):
+            codificacion = codificacion_para(cabeceras.get('Accept-Encoding'))
+            return 304, {'ETag': f'"{etag_representacion(base, codificacion)}"', 'Vary': 'Accept-Encoding'}, b''
+    
+    codificacion = codificacion_para(cabeceras.get('Accept-Encoding')) if len(cuerpo) >= COMPRESION_MINIMO else None
+    if codificacion:
+        cuerpo = comprimir(cuerpo, codificacion)
+        salida['Content-Encoding'] = codificacion
+    if base:
+        salida['ETag'] = f'"{etag_representacion(base, codificacion)}"'
+    salida['Content-Length'] = str(len(cuerpo))
+    return codigo, salida, b'' if metodo == 'HEAD' else cuerpo
+
+def environ_wsgi(scope, cuerpo):
+    """Entorno WSGI para un scope HTTP de ASGI"""
+    raiz = scope.get('root_path', '')
+    ruta = scope['path'][len(raiz):] if raiz and scope['path'].startswith(raiz) else scope['path']
+    servidor = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': raiz.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': ruta.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': servidor[0],
+        'SERVER_PORT': str(servidor[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': cuerpo,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for nombre, valor in scope['headers']:
+        nombre = nombre.decode('latin-1').upper().replace('-', '_')
+        valor = valor.decode('latin-1')
+        if nombre in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[nombre] = valor
+            continue
+        clave = f'HTTP_{nombre}'
+        environ[clave] = f'{environ[clave]},{valor}' if clave in environ else valor
+    return environ
+
+async def servir_wsgi(scope, receive, send, executor):
+    """Atender una petición con la app Flask en un hilo del executor sin bloquear el bucle"""
+    cuerpo = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    while True:
+        mensaje = await receive()
+        if mensaje['type'] == 'http.disconnect':
+            cuerpo.close()
+            return
+        cuerpo.write(mensaje.get('body', b''))
+        if not mensaje.get('more_body'):
+            break
+    cuerpo.seek(0)
+    
+    bucle = asyncio.get_running_loop()
+    desconectado = threading.Event()
+    
+    def enviar(mensaje):
+        asyncio.run_coroutine_threadsafe(send(mensaje), bucle).result()
+    
+    def ejecutar():
+        inicio = {}
+        
+        def start_response(estado, cabeceras, exc_info=None):
+            inicio.update(
+                type='http.response.start',
+                status=int(estado.split(' ', 1)[0]),
+                headers=[(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in cabeceras]
+            )
+        
+        salida = app(environ_wsgi(scope, cuerpo), start_response)
+        try:
+            enviado = False
+            for trozo in salida:
+                # uvicorn descarta lo enviado tras una desconexión: sin esto un stream SSE seguiría ocupando el hilo
+                if desconectado.is_set():
+                    return
+                if not enviado:
+                    enviar(inicio)
+                    enviado = True
+                if trozo:
+                    enviar({'type': 'http.response.body', 'body': trozo, 'more_body': True})
+            if not enviado:
+                enviar(inicio)
+            enviar({'type': 'http.response.body'})
+        finally:
+            # close() dispara call_on_close (p. ej. desuscribir el canal del chat)
+            if hasattr(salida, 'close'):
+                salida.close()
+            cuerpo.close()
+    
+    async def vigilar_desconexion():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        desconectado.set()
+    
+    vigilante = asyncio.ensure_future(vigilar_desconexion())
+    try:
+        await bucle.run_in_executor(executor, ejecutar)
+    finally:
+        vigilante.cancel()
+
+async def ciclo_de_vida_asgi(receive, send):
+    while True:
+        mensaje = await receive()
+        if mensaje['type'] == 'lifespan.startup':
+            init_db()
+            await send({'type': 'lifespan.startup.complete'})
+        elif mensaje['type'] == 'lifespan.shutdown':
+            await cerrar_cliente_async()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def crear_app_asgi():
+    """Aplicación ASGI: RUTAS_ASYNC con corrutinas y todo lo demás en Flask sobre un pool de hilos propio"""
+    executor_flask = ThreadPoolExecutor(max_workers=ASGI_HILOS_FLASK, thread_name_prefix='flask')
+    
+    async def asgi_app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await ciclo_de_vida_asgi(receive, send)
+        if scope['type'] != 'http':
+            return
+        vista = RUTAS_ASYNC.get(scope['path']) if scope['method'] in ('GET', 'HEAD') else None
+        if vista is None:
+            return await servir_wsgi(scope, receive, send, executor_flask)
+        
+        args = MultiDict(parse_qsl(scope['query_string'].decode('utf-8', 'replace'), keep_blank_values=True))
+        cabeceras = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']])
+        # Sin 'client' (socket unix, algunos proxies) se geolocaliza la IP del servidor
+        cliente = scope['client'][0] if scope.get('client') else ''
+        try:
+            datos, codigo, extra = await vista(args, cabeceras, cliente), 200, {}
+        except Exception as e:
+            datos, codigo, extra = descripcion_error(e)
+        
+        codigo, salida, cuerpo = representacion_json(datos, codigo, cabeceras, scope['method'], extra)
+        await send({
+            'type': 'http.response.start',
+            'status': codigo,
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in salida.items()]
+        })
+        await send({'type': 'http.response.body', 'body': cuerpo})
+    
+    return asgi_app
+
+asgi_app = crear_app_asgi() if aiohttp is not None else None
+
+# ==================== BENCHMARK DE CONCURRENCIA ====================
+def upstream_simulado(latencia):
+    """Upstream ASGI local que responde JSON vacío tras una latencia fija (imita a Overpass)"""
+    async def aplicacion(scope, receive, send):
+        while (await receive()).get('more_body'):
+            pass
+        await asyncio.sleep(latencia)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': b'{"elements": []}'})
+    return aplicacion
+
+def servidor_uvicorn(aplicacion, lifespan='off'):
+    """Arrancar uvicorn en un hilo sobre un puerto libre; devuelve (servidor, hilo, puerto)"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    servidor = uvicorn.Server(uvicorn.Config(aplicacion, lifespan=lifespan, log_level='warning', backlog=4096))
+    hilo = threading.Thread(target=servidor.run, kwargs={'sockets': [sock]}, daemon=True)
+    hilo.start()
+    while not servidor.started:
+        time.sleep(0.01)
+    return servidor, hilo, sock.getsockname()[1]
+
+def servidor_hilos():
+    """Servidor de desarrollo de Werkzeug con un hilo por conexión"""
+    servidor = make_server('127.0.0.1', 0, app, threaded=True)
+    servidor.socket.listen(4096)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    return servidor, hilo, servidor.server_port
+
+async def medir_concurrencia(base_url, usuarios, peticiones):
+    """Lanzar usuarios concurrentes contra /api/lugares; devuelve latencias, códigos y duración"""
+    latencias, codigos = [], Counter()
+    conector = aiohttp.TCPConnector(limit=usuarios)
+    async with aiohttp.ClientSession(base_url, connector=conector, timeout=aiohttp.ClientTimeout(total=60)) as cliente:
+        async def usuario():
+            for _ in range(peticiones):
+                # Coordenadas aleatorias: cada petición cae en una tile sin cachear
+                params = {'lat': random.uniform(-60, 60), 'lon': random.uniform(-180, 180), 'radio': 100}
+                inicio = time.perf_counter()
+                try:
+                    async with cliente.get('/api/lugares', params=params) as response:
+                        await response.read()
+                        codigo = response.status
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    codigo = 'error'
+                latencias.append(time.perf_counter() - inicio)
+                codigos[codigo] += 1
+        
+        inicio = time.perf_counter()
+        await asyncio.gather(*(usuario() for _ in range(usuarios)))
+        return latencias, codigos, time.perf_counter() - inicio
+
+async def medir_aislamiento(base_url):
+    """Latencia de /api/productos con un stream SSE y un long-poll del chat abiertos; (código, ms)"""
+    async with aiohttp.ClientSession(base_url, timeout=aiohttp.ClientTimeout(total=10)) as cliente:
+        async with cliente.get('/api/chat/eventos') as stream:
+            await stream.content.readany()
+            long_poll = asyncio.ensure_future(cliente.get('/api/mensajes', params={'since': 2 ** 62, 'esperar': 25}))
+            await asyncio.sleep(0.2)
+            inicio = time.perf_counter()
+            try:
+                async with cliente.get('/api/productos') as response:
+                    await response.read()
+                    codigo = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                codigo = 'timeout'
+            long_poll.cancel()
+            return codigo, (time.perf_counter() - inicio) * 1000
+
+def medir_con_pico_de_hilos(base_url, usuarios, peticiones):
+    """medir_concurrencia vigilando el máximo de hilos del proceso por encima de los que había antes"""
+    base = threading.active_count()
+    pico = [base]
+    terminado = threading.Event()
+    
+    def vigilar():
+        while not terminado.wait(0.02):
+            pico[0] = max(pico[0], threading.active_count())
+    
+    monitor = threading.Thread(target=vigilar, daemon=True)
+    monitor.start()
+    try:
+        latencias, codigos, duracion = asyncio.run(medir_concurrencia(base_url, usuarios, peticiones))
+    finally:
+        terminado.set()
+        monitor.join()
+    # El hilo vigilante no cuenta
+    return latencias, codigos, duracion, pico[0] - base - 1
+
+@app.cli.command('benchmark-upstream')
+@click.option('--usuarios', default='10,100,500', help='Niveles de concurrencia separados por comas')
+@click.option('--peticiones', default=3, type=int, help='Peticiones por usuario')
+@click.option('--latencia', default=0.5, type=float, help='Latencia del upstream simulado (s)')
+@click.option('--modos', default='hilos,async', help='Modos a comparar: hilos (Flask/Werkzeug) y async (asgi_app)')
+@click.option('--bulkhead', default=10000, type=int, help='Concurrencia permitida hacia el upstream simulado')
+def benchmark_upstream_comando(usuarios, peticiones, latencia, modos, bulkhead):
+    """Comparar la capacidad del modo con hilos y del modo asíncrono frente a un upstream local lento"""
+    global OVERPASS_URL
+    if aiohttp is None:
+        raise click.ClickException('El benchmark necesita aiohttp y uvicorn (ver requeriments.txt)')
+    
+    # El bulkhead de Overpass se amplía para medir el modo de ejecución y no el límite del proveedor
+    os.environ['BULKHEAD_OVERPASS'] = str(bulkhead)
+    with _circuitos_lock:
+        circuitos_upstream.pop('overpass', None)
+    
+    init_db()
+    upstream, hilo_upstream, puerto = servidor_uvicorn(upstream_simulado(latencia))
+    OVERPASS_URL = f'http://127.0.0.1:{puerto}/api/interpreter'
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    
+    print(f"Upstream simulado con {latencia}s de latencia; bulkhead overpass = {circuito_de('overpass').concurrencia}")
+    print(f"{'modo':>6} {'usuarios':>9} {'ok':>6} {'503':>6} {'otros':>6} {'p50 ms':>8} {'p95 ms':>8} {'req/s':>8} {'hilos':>6}")
+    try:
+        for modo in (m.strip() for m in modos.split(',')):
+            if modo == 'async':
+                servidor, hilo, puerto = servidor_uvicorn(asgi_app, lifespan='on')
+            else:
+                servidor, hilo, puerto = servidor_hilos()
+            try:
+                for nivel in (int(n) for n in usuarios.split(',')):
+                    latencias, codigos, duracion, hilos = medir_con_pico_de_hilos(f'http://127.0.0.1:{puerto}', nivel, peticiones)
+                    latencias.sort()
+                    p50 = latencias[len(latencias) // 2] * 1000
+                    p95 = latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))] * 1000
+                    otros = sum(codigos.values()) - codigos[200] - codigos[503]
+                    print(f"{modo:>6} {nivel:>9} {codigos[200]:>6} {codigos[503]:>6} {otros:>6} {p50:>8.0f} {p95:>8.0f} "
+                          f"{len(latencias) / duracion:>8.1f} {hilos:>6}")
+                # Las rutas de Flask no deben quedar detrás de un stream SSE ni de un long-poll
+                codigo, ms = asyncio.run(medir_aislamiento(f'http://127.0.0.1:{puerto}'))
+                print(f"{modo:>6} /api/productos con SSE y long-poll abiertos: {codigo} en {ms:.0f} ms")
+            finally:
+                if modo == 'async':
+                    servidor.should_exit = True
+                else:
+                    servidor.shutdown()
+                hilo.join()
+    finally:
+        upstream.should_exit = True
+        hilo_upstream.join()
+
 # ==================== MAIN ====================
 if __name__ == '__main__':
     # Verificar que las API keys estén configuradas